@@ -0,0 +1,212 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import platform
+import tempfile
+import subprocess
+import psycopg2
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# The default database, which exists before create_tables.py has run
+DSN = "host=127.0.0.1 dbname=studentdb user=student password=student"
+
+# Scale point added by --large, the top of the generator's range
+LARGE_SCALE = 10000000
+
+
+def environment():
+    """
+    Describes the machine the benchmark runs on, stored with the results
+    so a baseline from another machine can be recognised.
+    """
+    conn = psycopg2.connect(DSN)
+    cur = conn.cursor()
+    cur.execute("SHOW server_version")
+    postgres = cur.fetchone()[0]
+    conn.close()
+    return {"cpu_count": os.cpu_count(),
+            "machine": platform.machine(),
+            "python": platform.python_version(),
+            "postgres": postgres}
+
+
+def calibrate(repeat=5):
+    """
+    Measures the speed of this machine on a fixed workload of JSON
+    parsing and hashing, the Python side of loading a log file.
+    Throughput divided by this score compares across machines.
+
+    :param repeat: Number of timed runs, the fastest is kept
+    :return: Workload runs per second
+    """
+    lines = [json.dumps({"ts": 1541105830796 + i, "userId": str(i % 97), "page": "NextSong",
+                         "song": "Song {}".format(i), "length": i / 7.0}).encode()
+             for i in range(50000)]
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        digest = hashlib.sha256()
+        for line in lines:
+            json.loads(line)
+            digest.update(line)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return 1 / best
+
+
+def run(args, cwd):
+    """
+    Runs a Python script in 'cwd' and returns its wall time and peak RSS.
+
+    :param args: Script path followed by its arguments
+    :param cwd: Working directory
+    :return: (seconds, peak RSS in MB)
+    """
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable] + args, cwd=cwd, stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, args)
+    # ru_maxrss is in kilobytes on Linux
+    return time.perf_counter() - start, usage.ru_maxrss / 1024
+
+
+def bench_scale(events, workdir, generate_args, etl_args, repeat=1):
+    """
+    Generates a dataset of 'events' log events, then 'repeat' times
+    recreates the database and loads the data with etl.py. The fastest
+    load is kept, along with the spread between the loads, a measure of
+    the run-to-run noise.
+
+    :param events: Number of log events to generate
+    :param workdir: Directory the dataset is generated in
+    :param generate_args: Extra arguments for generate_data.py
+    :param etl_args: Extra arguments for etl.py
+    :param repeat: Number of loads
+    :return: Dict of results for this scale point
+    """
+    data_dir = os.path.join(workdir, "data")
+    shutil.rmtree(data_dir, ignore_errors=True)
+    run([os.path.join(HERE, "generate_data.py"), "--out", data_dir,
+         "--events", str(events)] + generate_args, workdir)
+
+    loads = []
+    for _ in range(repeat):
+        run([os.path.join(HERE, "create_tables.py")], workdir)
+        report_path = os.path.join(workdir, "etl_report.json")
+        seconds, peak_rss = run([os.path.join(HERE, "etl.py"), "--report", report_path] + etl_args, workdir)
+        with open(report_path) as f:
+            report = json.load(f)
+        loads.append((seconds, peak_rss, report))
+
+    seconds, peak_rss, report = min(loads, key=lambda load: load[0])
+    rows = sum(f["rows"] for f in report["files"] if f["phase"] == "log_data")
+
+    return {"events": events,
+            "songplays": rows,
+            "seconds": seconds,
+            "songplays_per_sec": rows / seconds,
+            "spread": 1 - seconds / max(load[0] for load in loads),
+            "peak_rss_mb": peak_rss,
+            "stages": report["stages"]}
+
+
+def compare(run_info, baseline, tolerance):
+    """
+    Prints throughput and memory of each scale point relative to the
+    baseline and returns whether any point regressed by more than
+    'tolerance', widened to the run-to-run spread measured for the point.
+    Against a baseline recorded on another machine throughput is
+    normalised by each run's calibration score; on the same machine the
+    score's own noise would only add to the comparison's.
+
+    :param run_info: Results of this run
+    :param baseline: Results loaded from the baseline file
+    :param tolerance: Allowed relative regression, e.g. 0.1 for 10%
+    """
+    scale = 1.0
+    normalised = baseline.get("environment") != run_info["environment"] and "calibration" in baseline
+    if normalised:
+        print('baseline recorded on {}, this run on {}; comparing normalised throughput'.format(
+            baseline["environment"], run_info["environment"]))
+        scale = baseline["calibration"] / run_info["calibration"]
+
+    regressed = False
+    points = {point["events"]: point for point in baseline["results"]}
+    for point in run_info["results"]:
+        base = points.get(point["events"])
+        if base is None:
+            print('{:>10} events: no baseline'.format(point["events"]))
+            continue
+        speed = point["songplays_per_sec"] * scale / base["songplays_per_sec"]
+        memory = point["peak_rss_mb"] / base["peak_rss_mb"]
+        allowed = max(tolerance, point.get("spread", 0), base.get("spread", 0))
+        slower = speed < 1 - allowed
+        regressed |= slower
+        print('{:>10} events: {:.2f}x {}songplays/sec, {:.2f}x peak RSS, {:.0%} allowed{}'.format(
+            point["events"], speed, "normalised " if normalised else "", memory, allowed,
+            "  REGRESSION" if slower else ""))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark create_tables.py + etl.py on generated data against a local Postgres. "
+                    "Note: this drops and recreates sparkifydb.")
+    parser.add_argument("--scales", type=int, nargs="+", default=[10000, 100000, 1000000],
+                        help="numbers of log events to benchmark")
+    parser.add_argument("--large", action="store_true",
+                        help="also benchmark {} events (takes tens of minutes and several GB of disk)".format(LARGE_SCALE))
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="loads per scale point; the fastest is kept and their spread widens the tolerance")
+    parser.add_argument("--workdir", help="directory to generate data in (default: a temporary directory)")
+    parser.add_argument("--output", default="benchmark_results.json", help="file the results are written to")
+    parser.add_argument("--baseline", default=os.path.join(HERE, "benchmarks", "baseline.json"),
+                        help="baseline results to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed regression of normalised songplays/sec against the baseline")
+    parser.add_argument("--generate-args", default="", help="extra arguments for generate_data.py")
+    parser.add_argument("--etl-args", default="", help="extra arguments for etl.py")
+    args = parser.parse_args()
+
+    scales = args.scales + ([LARGE_SCALE] if args.large and LARGE_SCALE not in args.scales else [])
+
+    run_info = {"etl_args": args.etl_args,
+                "generate_args": args.generate_args,
+                "environment": environment(),
+                "calibration": calibrate()}
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="sparkify-bench-")
+    results = []
+    for events in scales:
+        point = bench_scale(events, workdir, args.generate_args.split(), args.etl_args.split(), args.repeat)
+        print('{events:>10} events: {songplays} songplays in {seconds:.1f}s, '
+              '{songplays_per_sec:.0f} songplays/sec, peak RSS {peak_rss_mb:.0f} MB, '
+              '{spread:.0%} spread'.format(**point))
+        results.append(point)
+    if not args.workdir:
+        shutil.rmtree(workdir)
+    run_info["results"] = results
+    with open(args.output, "w") as f:
+        json.dump(run_info, f, indent=2)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(run_info, f, indent=2)
+        print('baseline saved to {}'.format(args.baseline))
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            if compare(run_info, json.load(f), args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
+import argparse
 import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+from sql_queries import create_table_queries, drop_table_queries, create_index_queries, analyze_tables
 
 
 def create_database():
@@ -34,11 +35,35 @@ def create_tables(cur, conn):
         conn.commit()
 
 
+def create_indexes(cur, conn):
+    """
+    Adds the primary keys and lookup indexes to the tables and
+    refreshes their planner statistics.
+
+    :param cur: DB cursor
+    :param conn: Connection to DB
+    """
+    for query in create_index_queries:
+        cur.execute(query)
+        conn.commit()
+
+    cur.execute(analyze_tables)
+    conn.commit()
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Create the Sparkify database and tables.")
+    parser.add_argument("--bulk-load", action="store_true",
+                        help="create the tables without primary keys and indexes, "
+                             "for a backfill with 'etl.py --bulk-load'")
+    args = parser.parse_args()
+
     cur, conn = create_database()
     
     drop_tables(cur, conn)
     create_tables(cur, conn)
+    if not args.bulk_load:
+        create_indexes(cur, conn)
 
     conn.close()
 
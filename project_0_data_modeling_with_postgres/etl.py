@@ -1,12 +1,37 @@
 import os
+import io
 import glob
+import gzip
+import hashlib
+import argparse
+from functools import partial
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import psycopg2
+from psycopg2.extras import execute_values
 import pandas as pd
 from sql_queries import *
+from song_index import SongIndex
+from run_metrics import metrics
+from create_tables import create_indexes
+from partitions import ensure_partitions
+from rollups import rebuild_rollups
+
+try:
+    import orjson as json
+except ImportError:
+    import json
+
+DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+
+LOG_COLUMNS = ["artist", "firstName", "gender", "lastName", "length", "level",
+               "location", "page", "sessionId", "song", "ts", "userAgent", "userId"]
 
 
 def process_song_file(cur, 
-                      filepath):
+                      filepath,
+                      index=None,
+                      digests=None):
     """
     Extracts song and artist information from song data files and
     inserts into corresponding 'songs' and 'artists' tables.
@@ -16,63 +41,133 @@ def process_song_file(cur,
     
     :param cur: DB cursor
     :param filepath: Path of the song file to process
+    :param index: SongIndex to update with the inserted song (optional)
+    :param digests: Dict of path to hashlib object fed the bytes read (optional)
+    :return: Number of songs in the file
     """
     # open song file
-    df = pd.read_json(filepath, typ="series")
+    with metrics.stage("parse") as stage:
+        with open(filepath, "rb") as f:
+            data = f.read()
+        if digests is not None:
+            digests[filepath].update(data)
+        df = pd.read_json(io.BytesIO(data), typ="series")
+        stage.rows = 1
 
-    # insert song record
-    song_data = df.values[[6, 7, 1, 9, 8]]
-    song_data = list(song_data)
-    cur.execute(song_table_insert, song_data)
-    
-    # insert artist record
-    artist_data = df.values[[1, 5, 4, 2, 3]]
-    artist_data = list(artist_data)
-    cur.execute(artist_table_insert, artist_data)
+    with metrics.stage("insert") as stage:
+        # insert song record
+        song_data = df.values[[6, 7, 1, 9, 8]]
+        song_data = list(song_data)
+        cur.execute(song_table_insert, song_data)
+        
+        # insert artist record
+        artist_data = df.values[[1, 5, 4, 2, 3]]
+        artist_data = list(artist_data)
+        cur.execute(artist_table_insert, artist_data)
+        stage.rows = 2
+
+    if index is not None:
+        index.add(df.title, df.artist_name, df.duration, df.song_id, df.artist_id)
 
+    return 1
 
-def process_log_file(cur, filepath):
+
+def read_song_file(filepath, digest=None):
     """
-    Extracts user listening data from log data and inserts 
-    into Fact Table 'songplays' and Dimension Tables 'users',
-    'songs', 'artists' and 'time'.
-    
+    Parses a song data file into a list of song records. Files hold a
+    single JSON document or one document per line.
+
+    :param filepath: Path of the song file to read
+    :param digest: hashlib object fed the bytes read (optional)
+    """
+    with open(filepath, "rb") as f:
+        data = f.read()
+    if digest is not None:
+        digest.update(data)
+    try:
+        return [json.loads(data)]
+    except ValueError:
+        return [json.loads(line) for line in data.splitlines() if line.strip()]
+
+
+def process_song_files(cur, filepaths, index=None, readers=8, digests=None):
+    """
+    Batch variant of 'process_song_file'.
+
+    The files are read concurrently and their songs and artists are
+    written with one multi-row INSERT per table.
+
     :param cur: DB cursor
-    :param filepath: Path of the log file to process
+    :param filepaths: Paths of the song files to process
+    :param index: SongIndex to update with the inserted songs (optional)
+    :param readers: Number of threads reading files
+    :param digests: Dict of path to hashlib object fed the bytes read (optional)
+    :return: Number of songs in each file
     """
-    
-    # open log file
-    df = pd.read_json(filepath, lines=True)
+    with metrics.stage("parse") as stage:
+        with ThreadPoolExecutor(readers) as pool:
+            file_records = list(pool.map(lambda path: read_song_file(path, digests[path] if digests else None),
+                                         filepaths))
+        records = [record for file_record in file_records for record in file_record]
+        stage.rows = len(records)
 
-    # filter by NextSong action
-    df = df[df["page"] == "NextSong"]
+    with metrics.stage("transform") as stage:
+        # rows are sorted by key so concurrent loaders lock them in the same order
+        song_data = sorted((r["song_id"], r["title"], r["artist_id"], r["year"], r["duration"])
+                           for r in records)
+        artist_data = sorted((r["artist_id"], r["artist_name"], r["artist_location"],
+                              r["artist_latitude"], r["artist_longitude"])
+                             for r in records)
+        stage.rows = len(records)
 
-    # convert timestamp column to datetime
-    t = pd.to_datetime(df['ts'])
-    
-    # insert time data records
-    time_data = {"timestamp": t.values, 
-                 "hour": t.dt.hour.values, 
-                 "day": t.dt.day.values, 
-                 "week": t.dt.week.values, 
-                 "month": t.dt.month.values, 
-                 "year": t.dt.year.values, 
-                 "weekday": t.dt.weekday.values}
-    
-    column_labels = ("timestamp", "hour", "day", "week", "month", "year", "weekday")
-    time_df = pd.DataFrame(time_data)
+    with metrics.stage("insert") as stage:
+        execute_values(cur, song_table_batch_insert, song_data, page_size=len(song_data) or 1)
+        execute_values(cur, artist_table_batch_insert, artist_data, page_size=len(artist_data) or 1)
+        stage.rows = len(song_data) + len(artist_data)
+
+    if index is not None:
+        for r in records:
+            index.add(r["title"], r["artist_name"], r["duration"], r["song_id"], r["artist_id"])
+
+    return [len(file_record) for file_record in file_records]
 
-    for i, row in time_df.iterrows():
-        cur.execute(time_table_insert, list(row))
 
-    # load user table
-    user_df = df[["userId", "firstName", "lastName", "gender", "level"]]
+def insert_rows(cur, query, df):
+    """
+    Inserts the rows of 'df' one statement at a time.
 
-    # insert user records
-    for i, row in user_df.iterrows():
-        cur.execute(user_table_insert, row)
+    :param cur: DB cursor
+    :param query: Single-row INSERT statement
+    :param df: DataFrame whose columns match the statement parameters
+    """
+    for i, row in df.iterrows():
+        cur.execute(query, list(row))
 
-    # insert songplay records
+
+def copy_rows(cur, table, df):
+    """
+    Streams the rows of 'df' into 'table' with COPY.
+
+    :param cur: DB cursor
+    :param table: Name of the (staging) table to copy into
+    :param df: DataFrame whose columns match the table columns
+    """
+    buf = io.StringIO()
+    df.to_csv(buf, index=False, header=False)
+    buf.seek(0)
+    cur.copy_expert(staging_copy.format(table), buf)
+
+
+def select_songs(cur, df):
+    """
+    Looks up song and artist IDs for each log event with 'song_select',
+    one query per event.
+
+    :param cur: DB cursor
+    :param df: Log events with 'song', 'artist' and 'length' columns
+    :return: DataFrame with 'song_id' and 'artist_id' columns aligned with 'df'
+    """
+    song_ids = []
     for index, row in df.iterrows():
         
         # get songid and artistid from song and artist tables
@@ -80,60 +175,601 @@ def process_log_file(cur, filepath):
         results = cur.fetchone()
         
         if results:
-            songid, artistid = results
+            song_ids.append(results)
+        else:
+            song_ids.append((None, None))
+
+    return pd.DataFrame(song_ids, index=df.index, columns=["song_id", "artist_id"], dtype=object)
+
+
+def build_time_df(ts):
+    """
+    Builds 'time' dimension rows for the distinct timestamps in 'ts'.
+    Timestamps loaded before are dropped by 'LoadedTimes'. Weeks are ISO
+    calendar weeks.
+
+    :param ts: Series of epoch millisecond timestamps
+    """
+    ts = pd.unique(ts.to_numpy("int64"))
+    t = pd.to_datetime(ts, unit="ms")
+    return pd.DataFrame({"start_time": t,
+                         "hour": t.hour,
+                         "day": t.day,
+                         "week": t.isocalendar()["week"].to_numpy("int64"),
+                         "month": t.month,
+                         "year": t.year,
+                         "weekday": t.weekday})
+
+
+class LoadedTimes:
+    """
+    Range check dropping 'time' rows that are already in the table, so
+    they are not staged and written again.
+
+    'high' is the latest timestamp the table may hold: its max(start_time)
+    when the run started, raised with every chunk loaded. Timestamps after
+    it are new. Timestamps up to it are looked up in the table over the
+    chunk's range, so a late or reprocessed file still gets its missing
+    rows. Only this one value is kept across chunks, and the ON CONFLICT
+    clause still covers rows written concurrently by other workers.
+    """
+
+    def __init__(self):
+        self.high = None
+        self.started = False
+
+    def drop_loaded(self, cur, time_df):
+        """
+        Returns the rows of 'time_df' not yet in the 'time' table.
+
+        :param cur: DB cursor
+        :param time_df: 'time' rows from 'build_time_df'
+        """
+        if not self.started:
+            cur.execute(time_latest_select)
+            self.high = cur.fetchone()[0]
+            self.started = True
+        if self.high is None or time_df.empty:
+            return time_df
+
+        start_time = time_df["start_time"]
+        seen = start_time <= self.high
+        if seen.any():
+            cur.execute(time_range_select, (start_time[seen].min(), start_time[seen].max()))
+            loaded = pd.to_datetime([row[0] for row in cur.fetchall()])
+            time_df = time_df[~(seen & start_time.isin(loaded))]
+        return time_df
+
+    def advance(self, ts):
+        """
+        Raises 'high' past the timestamps of a loaded chunk.
+
+        :param ts: Series of epoch millisecond timestamps
+        """
+        if len(ts):
+            latest = pd.to_datetime(ts.max(), unit="ms")
+            self.high = latest if self.high is None else max(self.high, latest)
+
+
+def build_user_df(df):
+    """
+    Collapses log events to one 'users' row per user, taken from the
+    user's latest event by 'ts' so 'level' is their current one.
+
+    :param df: Log events
+    """
+    latest = df.sort_values("ts", kind="stable").drop_duplicates("userId", keep="last")
+    return latest[["userId", "firstName", "lastName", "gender", "level"]].sort_values("userId")
+
+
+class HashingReader:
+    """
+    Binary file wrapper feeding every byte read to a hashlib object, so
+    a file is hashed in the same pass that parses it.
+    """
+
+    def __init__(self, f, digest):
+        self.f = f
+        self.digest = digest
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.digest.update(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self.f.readline(size)
+        self.digest.update(data)
+        return data
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+
+def read_log_chunks(filepath, chunksize=10000, digest=None):
+    """
+    Streams the NextSong events of a JSON-lines log file, plain or
+    gzipped, as DataFrames of at most 'chunksize' events.
+
+    Lines that cannot be NextSong events are dropped before they are
+    parsed, so memory use is bounded by the chunk size rather than
+    the file size.
+
+    :param filepath: Path of the log file, optionally ending in '.gz'
+    :param chunksize: Maximum number of events per DataFrame
+    :param digest: hashlib object fed the file's bytes as stored (optional)
+    """
+    records = []
+    with open(filepath, "rb") as raw:
+        if digest is not None:
+            raw = HashingReader(raw, digest)
+        f = gzip.GzipFile(fileobj=raw, mode="rb") if filepath.endswith(".gz") else raw
+        for line in f:
+            if b"NextSong" not in line:
+                continue
+            record = json.loads(line)
+            if record.get("page") != "NextSong":
+                continue
+            records.append(record)
+            if len(records) == chunksize:
+                yield pd.DataFrame(records, columns=LOG_COLUMNS)
+                records = []
+        # bytes the decompressor left unread still belong to the file's hash
+        while raw.read(1 << 20):
+            pass
+    if records:
+        yield pd.DataFrame(records, columns=LOG_COLUMNS)
+
+
+def process_log_events(cur, df, mode="bulk", index=None, bulk_load=False, partitions=None,
+                       times=None):
+    """
+    Transforms a chunk of NextSong events and loads it into the
+    'time', 'users' and 'songplays' tables.
+
+    In 'bulk' mode the rows for each table are copied into temporary
+    staging tables and merged with one INSERT ... SELECT per table.
+    In 'row' mode every row is inserted with its own statement. The
+    songplays inserted are added to the rollup tables by the same
+    statement, except during a bulk load.
+
+    :param cur: DB cursor
+    :param df: NextSong log events
+    :param mode: 'bulk' or 'row'
+    :param index: SongIndex used to resolve song and artist IDs; when
+                  None each event is looked up with 'song_select'
+    :param bulk_load: Whether the tables are being bulk loaded without
+                      primary keys, in which case users are appended
+                      rather than upserted
+    :param partitions: Set of songplays partitions already known to exist (optional)
+    :param times: LoadedTimes skipping timestamps already in 'time' (optional);
+                  not used during a bulk load, when 'time' has no key to look up
+    :return: Number of songplays loaded
+    """
+    with metrics.stage("transform") as stage:
+        # time records, one per timestamp of the chunk
+        time_df = build_time_df(df["ts"])
+
+        # user records, one per user
+        user_df = build_user_df(df)
+        stage.rows = len(df)
+
+    # songplay records
+    with metrics.stage("lookup") as stage:
+        if index is None:
+            song_ids = select_songs(cur, df)
         else:
-            songid, artistid = None, None
+            song_ids = index.lookup(df)
+        stage.rows = len(df)
 
-        # insert songplay record
-        songplay_data = (row.ts, row.userId, row.level, songid, artistid, row.sessionId, row.location, row.userAgent)
-        cur.execute(songplay_table_insert, songplay_data)
+    with metrics.stage("transform"):
+        songplay_df = pd.DataFrame({"start_time": pd.to_datetime(df["ts"], unit="ms"),
+                                    "user_id": df["userId"],
+                                    "level": df["level"],
+                                    "song_id": song_ids["song_id"],
+                                    "artist_id": song_ids["artist_id"],
+                                    "session_id": df["sessionId"],
+                                    "location": df["location"],
+                                    "user_agent": df["userAgent"]})
 
+    with metrics.stage("insert") as stage:
+        if times is not None and not bulk_load:
+            time_df = times.drop_loaded(cur, time_df)
+        stage.rows = len(time_df) + len(user_df) + len(songplay_df)
+        ensure_partitions(cur, songplay_df["start_time"], partitions)
 
-def process_data(cur, conn, filepath, func):
+        if mode == "row":
+            insert_rows(cur, time_table_insert, time_df)
+            insert_rows(cur, user_table_insert, user_df)
+            insert_rows(cur, songplay_table_insert_rollup, songplay_df)
+        else:
+            if len(time_df):
+                copy_rows(cur, "time_staging", time_df)
+            copy_rows(cur, "user_staging", user_df)
+            copy_rows(cur, "songplay_staging", songplay_df)
+
+            if len(time_df):
+                cur.execute(time_table_merge)
+            cur.execute(user_table_append if bulk_load else user_table_merge)
+            cur.execute(songplay_table_merge if bulk_load else songplay_table_merge_rollup)
+            cur.execute(staging_truncate)
+
+    if times is not None:
+        times.advance(df["ts"])
+    return len(songplay_df)
+
+
+
+def process_log_file(cur, filepath, mode="bulk", index=None, chunksize=10000,
+                     bulk_load=False, partitions=None, times=None, digests=None):
+    """
+    Extracts user listening data from log data and inserts 
+    into Fact Table 'songplays' and Dimension Tables 'users',
+    'songs', 'artists' and 'time'.
+
+    The file is read and loaded in chunks of 'chunksize' NextSong
+    events, see 'process_log_events'.
+    
+    :param cur: DB cursor
+    :param filepath: Path of the log file to process
+    :param mode: 'bulk' or 'row'
+    :param index: SongIndex used to resolve song and artist IDs; when
+                  None each event is looked up with 'song_select'
+    :param chunksize: Number of events transformed and loaded at a time
+    :param bulk_load: Whether the tables are being bulk loaded without primary keys
+    :param partitions: Set of songplays partitions already known to exist (optional)
+    :param times: LoadedTimes skipping timestamps already in 'time' (optional)
+    :param digests: Dict of path to hashlib object fed the bytes read (optional)
+    :return: Number of songplays in the file
+    """
+    if mode == "bulk":
+        for query in staging_table_create_queries:
+            cur.execute(query)
+
+    songplays = 0
+    chunks = read_log_chunks(filepath, chunksize, digests[filepath] if digests else None)
+    while True:
+        with metrics.stage("parse") as stage:
+            df = next(chunks, None)
+            stage.rows = 0 if df is None else len(df)
+        if df is None:
+            break
+        songplays += process_log_events(cur, df, mode, index, bulk_load, partitions, times)
+
+    return songplays
+
+
+def file_hash(filepath):
+    """
+    Returns the SHA-256 hex digest of a file's contents.
+
+    :param filepath: Path of the file to hash
+    """
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def find_new_files(cur, all_files):
+    """
+    Compares files against the load manifest and returns the ones that
+    are new or whose contents changed since they were loaded.
+
+    Files with the size and mtime recorded in the manifest are skipped
+    without being read. Files that were touched but still hash the same
+    only have their manifest entry refreshed.
+
+    :param cur: DB cursor
+    :param all_files: Paths of the candidate files
+    :return: List of (path, size, mtime) tuples to process
+    """
+    cur.execute(load_manifest_select)
+    manifest = {path: (size, mtime, content_hash) for path, size, mtime, content_hash in cur}
+
+    new_files, touched = [], []
+    for path in all_files:
+        stat = os.stat(path)
+        entry = manifest.get(path)
+        if entry is not None and entry[:2] == (stat.st_size, stat.st_mtime):
+            continue
+        if entry is not None and entry[2] == file_hash(path):
+            touched.append((stat.st_size, stat.st_mtime, path))
+            continue
+        new_files.append((path, stat.st_size, stat.st_mtime))
+
+    if touched:
+        cur.executemany(load_manifest_touch, touched)
+    return new_files
+
+
+def process_unit(cur, func, unit, batched):
+    """
+    Processes a file (or batch of files) and records it in the load
+    manifest within the same transaction. Files are hashed as they are
+    read, so the recorded hash is of the data that was loaded.
+
+    :param cur: DB cursor
+    :param func: Processing function
+    :param unit: List of (path, size, mtime) tuples
+    :param batched: Whether 'func' takes a list of files
+    """
+    paths = [path for path, size, mtime in unit]
+    digests = {path: hashlib.sha256() for path in paths}
+    with metrics.file(paths) as record:
+        rows = func(cur, paths, digests=digests) if batched else [func(cur, paths[0], digests=digests)]
+        record.rows = sum(n or 0 for n in rows)
+
+        with metrics.stage("insert"):
+            execute_values(cur, load_manifest_upsert,
+                           [(path, size, mtime, digests[path].hexdigest(), n or 0)
+                            for (path, size, mtime), n in zip(unit, rows)])
+
+
+_worker = {}
+
+
+def _init_worker(func):
+    """
+    Process pool initializer, opens the worker's own DB connection.
+
+    :param func: Processing function run by this worker
+    """
+    conn = psycopg2.connect(DSN)
+    _worker.update(conn=conn, cur=conn.cursor(), func=func)
+
+
+def _process_units(units, batched, phase, retries=3):
+    """
+    Processes 'units' in a pool worker as one transaction, retrying it
+    if it is rolled back after a deadlock with another worker.
+
+    :param units: Files (or batches of files) to process, as (path, size, mtime)
+    :param batched: Whether 'func' takes batches of files
+    :param phase: Metrics phase the work is recorded under
+    :param retries: Number of times a rolled back transaction is retried
+    :return: Number of files processed, the worker's song index hits and
+             misses and a metrics snapshot
+    """
+    conn, cur, func = _worker["conn"], _worker["cur"], _worker["func"]
+    metrics.phase = phase
+    index = getattr(func, "keywords", {}).get("index")
+    hits, misses = (index.hits, index.misses) if index is not None else (0, 0)
+
+    for attempt in range(retries + 1):
+        try:
+            for unit in units:
+                process_unit(cur, func, unit, batched)
+            with metrics.stage("commit"):
+                conn.commit()
+            break
+        except psycopg2.extensions.TransactionRollbackError:
+            conn.rollback()
+            # partitions of the rolled back work were never created
+            written = getattr(func, "keywords", {}).get("partitions")
+            if written is not None:
+                written.clear()
+            if attempt == retries:
+                raise
+
+    if index is not None:
+        hits, misses = index.hits - hits, index.misses - misses
+    return sum(len(unit) for unit in units), hits, misses, metrics.snapshot()
+
+
+def process_data(cur, conn, filepath, func, batch_size=None, commit_every=1, workers=1,
+                 patterns=('*.json',)):
     """
     File processing orchestration.
     
     The 'filepath' is traversed for files to be processed 
     and found files are processed by 'func'. DB operations
     are performed using cursor 'cur'.
+
+    Files already recorded in the load manifest with unchanged contents
+    are skipped, and every processed file is recorded there in the same
+    transaction as its data. 'func' returns the number of rows each
+    file produced.
+
+    When 'batch_size' is set 'func' is called with lists of up to
+    'batch_size' files instead of a single file.
+
+    With more than one worker the files are spread over a process pool
+    in which every worker has its own DB connection and commits its own
+    transactions. 'func' must then be picklable, e.g. a module level
+    function or a partial of one.
     
     :param cur: DB cursor
     :param conn: Connection to DB
     :param filepath: File path to traverse
     :param func: Processing function
+    :param batch_size: Number of files passed to 'func' per call (optional)
+    :param commit_every: Number of 'func' calls per transaction
+    :param workers: Number of worker processes
+    :param patterns: Glob patterns of the files to process
     """
-    # get all files matching extension from directory
+    # get all files matching extension from directory, in a stable order
     all_files = []
     for root, dirs, files in os.walk(filepath):
-        files = glob.glob(os.path.join(root,'*.json'))
-        for f in files :
-            all_files.append(os.path.abspath(f))
+        for pattern in patterns:
+            files = glob.glob(os.path.join(root, pattern))
+            for f in files :
+                all_files.append(os.path.abspath(f))
+    all_files.sort()
+
+    metrics.phase = os.path.basename(os.path.normpath(filepath))
+
+    # skip files that were loaded before
+    new_files = find_new_files(cur, all_files)
+    conn.commit()
 
     # get total number of files found
-    num_files = len(all_files)
-    print('{} files found in {}'.format(num_files, filepath))
+    num_files = len(new_files)
+    print('{} files found in {}, {} new or changed'.format(len(all_files), filepath, num_files))
+
+    if batch_size:
+        units = [new_files[i:i + batch_size] for i in range(0, num_files, batch_size)]
+    else:
+        units = [[datafile] for datafile in new_files]
+
+    if workers > 1:
+        index = getattr(func, "keywords", {}).get("index")
+        tasks = [units[i:i + commit_every] for i in range(0, len(units), commit_every)]
+        pool = ProcessPoolExecutor(workers,
+                                   mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=_init_worker,
+                                   initargs=(func,))
+        with pool:
+            done = 0
+            results = pool.map(_process_units, tasks,
+                               [bool(batch_size)] * len(tasks), [metrics.phase] * len(tasks))
+            for files, hits, misses, worker_metrics in results:
+                done += files
+                metrics.merge(worker_metrics)
+                if index is not None:
+                    index.hits += hits
+                    index.misses += misses
+                print('{}/{} files processed.'.format(done, num_files))
+        return
 
     # iterate over files and process
-    for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
+    done = 0
+    for i, unit in enumerate(units, 1):
+        process_unit(cur, func, unit, bool(batch_size))
+        done += len(unit)
+        if i % commit_every == 0:
+            with metrics.stage("commit"):
+                conn.commit()
+        print('{}/{} files processed.'.format(done, num_files))
+    with metrics.stage("commit"):
+        conn.commit()
+
+
+def finish_bulk_load(cur, conn, maintenance_work_mem="512MB"):
+    """
+    Completes a bulk load into bare tables: removes the duplicate rows
+    ON CONFLICT would have skipped, builds the primary keys and lookup
+    indexes in one pass, sets user levels from their latest songplay,
+    rebuilds the rollup tables and refreshes planner statistics.
+
+    :param cur: DB cursor
+    :param conn: Connection to DB
+    :param maintenance_work_mem: Memory Postgres may use per index build
+    """
+    cur.execute("SET maintenance_work_mem = %s", (maintenance_work_mem,))
+
+    with metrics.stage("dedupe"):
+        for query in dedupe_table_queries:
+            cur.execute(query)
         conn.commit()
-        print('{}/{} files processed.'.format(i, num_files))
+
+    with metrics.stage("index"):
+        create_indexes(cur, conn)
+
+    cur.execute(user_level_sync)
+    conn.commit()
+
+    with metrics.stage("rollup"):
+        rebuild_rollups(cur, conn)
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Load Sparkify song and log data into Postgres.")
+    parser.add_argument("--mode", choices=("bulk", "row"), default="bulk",
+                        help="load song data in multi-row batches and log data with COPY "
+                             "into staging tables (bulk), or one INSERT per row (row)")
+    parser.add_argument("--batch-size", type=int, default=1000,
+                        help="song files read and inserted per batch in bulk mode")
+    parser.add_argument("--commit-every", type=int, default=1,
+                        help="song batches per transaction in bulk mode")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes, each with its own DB connection")
+    parser.add_argument("--chunk-size", type=int, default=10000,
+                        help="log events transformed and loaded at a time")
+    parser.add_argument("--lookup", choices=("index", "query"), default="index",
+                        help="resolve songplay song/artist IDs from an in-memory index (index) "
+                             "or with one song_select query per event (query)")
+    parser.add_argument("--report", metavar="PATH",
+                        help="write a JSON run report with per-stage and per-file timings")
+    parser.add_argument("--prometheus", metavar="PATH",
+                        help="write per-stage metrics as a Prometheus textfile (.prom)")
+    parser.add_argument("--slow-factor", type=float, default=3.0,
+                        help="flag files taking this many times the median time per file")
+    parser.add_argument("--bulk-load", action="store_true",
+                        help="load into tables created with 'create_tables.py --bulk-load' and "
+                             "build their primary keys and indexes afterwards")
+    parser.add_argument("--maintenance-work-mem", default="512MB",
+                        help="maintenance_work_mem for building indexes after a bulk load")
+    args = parser.parse_args()
+    if args.bulk_load and args.mode != "bulk":
+        parser.error("--bulk-load requires --mode bulk")
+
     # Establish a connection to the database
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+    conn = psycopg2.connect(DSN)
     
     # Get a cursor for the DB
     cur = conn.cursor()
 
-    # Process the song data and log files
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file)
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+    cur.execute(load_manifest_table_create)
+    conn.commit()
+
+    if args.bulk_load:
+        cur.execute(primary_key_check)
+        if cur.fetchone()[0]:
+            parser.error("the tables already have primary keys, "
+                         "recreate them with 'create_tables.py --bulk-load' first")
+
+    # Load the song lookup index, kept current while songs are processed.
+    # Worker processes cannot update it, so parallel runs reload it once
+    # all song data is in.
+    index = None
+    if args.lookup == "index" and args.workers == 1:
+        index = SongIndex.load(cur)
+
+    # Process the song data and log files. All song data is committed
+    # before log processing starts so songplays can be matched.
+    if args.mode == "bulk":
+        process_data(cur, conn, filepath='data/song_data',
+                     func=partial(process_song_files, index=index),
+                     batch_size=args.batch_size, commit_every=args.commit_every,
+                     workers=args.workers)
+    else:
+        process_data(cur, conn, filepath='data/song_data',
+                     func=partial(process_song_file, index=index),
+                     workers=args.workers)
+
+    if args.lookup == "index" and index is None:
+        index = SongIndex.load(cur)
+
+    process_data(cur, conn, filepath='data/log_data',
+                 func=partial(process_log_file, mode=args.mode, index=index,
+                              chunksize=args.chunk_size,
+                              bulk_load=args.bulk_load, partitions=set(), times=LoadedTimes()),
+                 workers=args.workers, patterns=('*.json', '*.json.gz'))
+
+    if args.bulk_load:
+        metrics.phase = "bulk_load"
+        finish_bulk_load(cur, conn, args.maintenance_work_mem)
+    else:
+        # Files load in path order, or in any order across workers, and a
+        # changed older file is loaded again after newer ones; set each
+        # user's level from their latest songplay whatever the order
+        cur.execute(user_level_sync)
+        conn.commit()
+
+    if index is not None:
+        print('{} songs indexed, {} songplays matched, {} unmatched.'.format(len(index), index.hits, index.misses))
 
     # Processing finished, close the DB connection.
     conn.close()
 
+    metrics.print_summary(args.slow_factor)
+    if args.report:
+        metrics.write_json(args.report, args.slow_factor)
+    if args.prometheus:
+        metrics.write_prometheus(args.prometheus)
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,221 @@
+import os
+import gzip
+import string
+import argparse
+from datetime import datetime, timedelta
+import numpy as np
+
+try:
+    import orjson
+
+    def dumps(record):
+        return orjson.dumps(record)
+except ImportError:
+    import json
+
+    def dumps(record):
+        return json.dumps(record).encode("utf-8")
+
+FIRST_NAMES = ["Lily", "Kate", "Jacob", "Chloe", "Tegan", "Aleena", "Mohammad", "Ryan",
+               "Jayden", "Layla", "Matthew", "Avery", "Theodore", "Sara", "Cienna"]
+LAST_NAMES = ["Koch", "Harrell", "Klein", "Cuevas", "Levine", "Kirby", "Rodriguez", "Smith",
+              "Graves", "Griffin", "Jones", "Watkins", "Harris", "Johnson", "Freeman"]
+LOCATIONS = ["Chicago-Naperville-Elgin, IL-IN-WI", "San Francisco-Oakland-Hayward, CA",
+             "Atlanta-Sandy Springs-Roswell, GA", "Lansing-East Lansing, MI",
+             "Portland-South Portland, ME", "New York-Newark-Jersey City, NY-NJ-PA",
+             "Waterloo-Cedar Falls, IA", "Tampa-St. Petersburg-Clearwater, FL"]
+USER_AGENTS = ['"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) '
+               'Chrome/36.0.1985.143 Safari/537.36"',
+               '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.77.4 (KHTML, like Gecko) '
+               'Version/7.0.5 Safari/537.77.4"',
+               'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:31.0) Gecko/20100101 Firefox/31.0']
+OTHER_PAGES = ["Home", "Logout", "Settings", "Help", "About", "Upgrade", "Downgrade"]
+
+
+def random_id(rng, prefix, n, width=18):
+    """
+    Returns 'n' distinct IDs shaped like the Million Song Dataset ones,
+    e.g. 'SOUPIRU12A6D4FA1E1'.
+
+    :param rng: numpy random Generator
+    :param prefix: Two letter ID prefix ('SO' for songs, 'AR' for artists)
+    :param n: Number of IDs
+    :param width: Total ID length
+    """
+    alphabet = np.array(list(string.ascii_uppercase + string.digits))
+    ids = set()
+    while len(ids) < n:
+        chars = rng.choice(alphabet, size=(n - len(ids), width - len(prefix)))
+        ids.update(prefix + "".join(row) for row in chars)
+    return sorted(ids)
+
+
+def zipf_weights(n, skew):
+    """
+    Returns normalised Zipf weights for ranks 1..n; a skew of 0 gives a
+    uniform distribution.
+
+    :param n: Number of ranks
+    :param skew: Zipf exponent
+    """
+    weights = 1.0 / np.arange(1, n + 1) ** skew
+    return weights / weights.sum()
+
+
+def write_song_data(rng, out_dir, n_songs, n_artists, artist_skew):
+    """
+    Writes one song file per song under 'out_dir/song_data', laid out
+    as in the Million Song Dataset (song_data/A/B/C/TRABC....json).
+
+    :param rng: numpy random Generator
+    :param out_dir: Output directory
+    :param n_songs: Number of songs
+    :param n_artists: Number of artists
+    :param artist_skew: Zipf exponent of the number of songs per artist
+    :return: Dict of song arrays (title, artist_name, duration, ...)
+    """
+    artist_ids = random_id(rng, "AR", n_artists)
+    artist_names = ["Artist {}".format(i) for i in range(n_artists)]
+    artist_lat = rng.uniform(-60, 70, n_artists).round(5)
+    artist_lon = rng.uniform(-150, 150, n_artists).round(5)
+    artist_has_geo = rng.random(n_artists) < 0.4
+    artist_location = rng.choice(np.array(LOCATIONS + [""]), n_artists)
+
+    song_artist = rng.choice(n_artists, size=n_songs, p=zipf_weights(n_artists, artist_skew))
+    song_ids = random_id(rng, "SO", n_songs)
+    titles = ["Song {}".format(i) for i in range(n_songs)]
+    durations = rng.gamma(9.0, 26.0, n_songs).round(5) + 30.0
+    years = np.where(rng.random(n_songs) < 0.5, 0, rng.integers(1960, 2011, n_songs))
+
+    track_ids = random_id(rng, "TR", n_songs)
+    for i, track_id in enumerate(track_ids):
+        a = song_artist[i]
+        record = {"num_songs": 1,
+                  "artist_id": artist_ids[a],
+                  "artist_latitude": float(artist_lat[a]) if artist_has_geo[a] else None,
+                  "artist_longitude": float(artist_lon[a]) if artist_has_geo[a] else None,
+                  "artist_location": str(artist_location[a]),
+                  "artist_name": artist_names[a],
+                  "song_id": song_ids[i],
+                  "title": titles[i],
+                  "duration": float(durations[i]),
+                  "year": int(years[i])}
+        song_dir = os.path.join(out_dir, "song_data", track_id[2], track_id[3], track_id[4])
+        os.makedirs(song_dir, exist_ok=True)
+        with open(os.path.join(song_dir, track_id + ".json"), "wb") as f:
+            f.write(dumps(record))
+
+    return {"title": titles,
+            "artist_name": [artist_names[a] for a in song_artist],
+            "duration": durations}
+
+
+def write_log_data(rng, out_dir, songs, n_events, n_users, play_skew, song_skew,
+                   start, days, miss_rate, compress):
+    """
+    Writes one JSON-lines log file per day under 'out_dir/log_data'
+    (log_data/YYYY/MM/YYYY-MM-DD-events.json), matching the layout and
+    fields of the Sparkify event logs.
+
+    :param rng: numpy random Generator
+    :param out_dir: Output directory
+    :param songs: Song arrays returned by 'write_song_data'
+    :param n_events: Number of events, about 80% of them NextSong
+    :param n_users: Number of users
+    :param play_skew: Zipf exponent of the number of plays per user
+    :param song_skew: Zipf exponent of song popularity
+    :param start: Date of the first log file
+    :param days: Number of days (files) the events are spread over
+    :param miss_rate: Fraction of plays of songs missing from song_data
+    :param compress: Write gzipped '.json.gz' files
+    """
+    user_first = rng.choice(np.array(FIRST_NAMES), n_users)
+    user_last = rng.choice(np.array(LAST_NAMES), n_users)
+    user_gender = rng.choice(np.array(["F", "M"]), n_users)
+    user_location = rng.choice(np.array(LOCATIONS), n_users)
+    user_agent = rng.choice(np.array(USER_AGENTS), n_users)
+    user_registration = rng.integers(1530000000000, 1540000000000, n_users)
+    # some users upgrade from free to paid part way through
+    user_upgrade = rng.uniform(0, days * 86400000, n_users)
+    user_upgrade[rng.random(n_users) < 0.6] = np.inf
+
+    start_ms = int((datetime(start.year, start.month, start.day) - datetime(1970, 1, 1)).total_seconds() * 1000)
+    offsets = np.sort(rng.integers(0, days * 86400000, n_events))
+    users = rng.choice(n_users, size=n_events, p=zipf_weights(n_users, play_skew))
+    is_play = rng.random(n_events) < 0.8
+    pages = rng.choice(np.array(OTHER_PAGES), n_events)
+    song = rng.choice(len(songs["title"]), size=n_events, p=zipf_weights(len(songs["title"]), song_skew))
+    missing = rng.random(n_events) < miss_rate
+    sessions = (offsets // 1800000) * n_users + users
+
+    day_index = offsets // 86400000
+    for day in range(days):
+        date = start + timedelta(days=day)
+        log_dir = os.path.join(out_dir, "log_data", "{:%Y}".format(date), "{:%m}".format(date))
+        os.makedirs(log_dir, exist_ok=True)
+        name = "{:%Y-%m-%d}-events.json".format(date) + (".gz" if compress else "")
+        opener = gzip.open if compress else open
+
+        # songplays are keyed on (start_time, user_id), skip repeats
+        seen = set()
+        with opener(os.path.join(log_dir, name), "wb") as f:
+            for i in np.flatnonzero(day_index == day):
+                u, ts = int(users[i]), start_ms + int(offsets[i])
+                if (u, ts) in seen:
+                    continue
+                seen.add((u, ts))
+                record = {"artist": None, "auth": "Logged In",
+                          "firstName": str(user_first[u]), "gender": str(user_gender[u]),
+                          "itemInSession": int(i % 50), "lastName": str(user_last[u]),
+                          "length": None,
+                          "level": "paid" if offsets[i] >= user_upgrade[u] else "free",
+                          "location": str(user_location[u]), "method": "GET",
+                          "page": "NextSong" if is_play[i] else str(pages[i]),
+                          "registration": int(user_registration[u]),
+                          "sessionId": int(sessions[i] % 100000), "song": None, "status": 200,
+                          "ts": ts, "userAgent": str(user_agent[u]), "userId": str(u + 1)}
+                if is_play[i]:
+                    s = song[i]
+                    record["method"] = "PUT"
+                    record["song"] = songs["title"][s] + (" (Live)" if missing[i] else "")
+                    record["artist"] = songs["artist_name"][s]
+                    record["length"] = float(songs["duration"][s])
+                f.write(dumps(record) + b"\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic Sparkify song and log data.")
+    parser.add_argument("--out", default="data", help="output directory (song_data/ and log_data/ go here)")
+    parser.add_argument("--events", type=int, default=10000, help="number of log events")
+    parser.add_argument("--songs", type=int, help="number of songs (default: events / 10)")
+    parser.add_argument("--artists", type=int, help="number of artists (default: songs / 4)")
+    parser.add_argument("--users", type=int, help="number of users (default: events / 100, at least 100)")
+    parser.add_argument("--artist-skew", type=float, default=1.0,
+                        help="Zipf exponent of songs per artist (0 = uniform)")
+    parser.add_argument("--play-skew", type=float, default=1.0,
+                        help="Zipf exponent of plays per user (0 = uniform)")
+    parser.add_argument("--song-skew", type=float, default=1.1,
+                        help="Zipf exponent of plays per song (0 = uniform)")
+    parser.add_argument("--days", type=int, default=30, help="number of daily log files")
+    parser.add_argument("--start", default="2018-11-01", help="date of the first log file")
+    parser.add_argument("--miss-rate", type=float, default=0.05,
+                        help="fraction of plays of songs that are not in song_data")
+    parser.add_argument("--gzip", action="store_true", help="write gzipped log files")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    n_songs = args.songs or max(args.events // 10, 10)
+    n_artists = args.artists or max(n_songs // 4, 1)
+    n_users = args.users or max(args.events // 100, 100)
+
+    rng = np.random.default_rng(args.seed)
+    songs = write_song_data(rng, args.out, n_songs, n_artists, args.artist_skew)
+    write_log_data(rng, args.out, songs, args.events, n_users, args.play_skew, args.song_skew,
+                   datetime.strptime(args.start, "%Y-%m-%d").date(), args.days,
+                   args.miss_rate, args.gzip)
+    print('{} songs by {} artists, {} events by {} users written to {}'.format(
+        n_songs, n_artists, args.events, n_users, args.out))
+
+
+if __name__ == "__main__":
+    main()
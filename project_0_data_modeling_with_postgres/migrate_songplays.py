@@ -0,0 +1,72 @@
+import psycopg2
+import pandas as pd
+from sql_queries import (songplay_start_time_type, songplay_pkey_check, songplay_migrate_copy,
+                         songplay_migrate_months, songplay_migrate_insert, songplay_table_drop,
+                         songplay_table_create, songplay_partition_create, songplay_table_pkey)
+from partitions import partition_name, month_bounds
+from rollups import rebuild_rollups
+
+DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+
+
+def migrate_songplays(cur, conn):
+    """
+    Converts 'songplays.start_time' from bigint epoch milliseconds to
+    timestamp and 'songplays.user_id' from int to text, so songplays
+    join 'time' and 'users' on their primary keys without a per-row
+    conversion.
+
+    The rows are copied out, songplays is recreated with the current
+    partitioned definition and the rows are copied back, all in one
+    transaction. Existing primary keys are rebuilt. The rollup tables,
+    which databases this old do not have, are then created and built
+    from the migrated songplays, as the loader maintains them.
+
+    :param cur: DB cursor
+    :param conn: Connection to DB
+    :return: Number of songplays migrated, None if already migrated
+    """
+    cur.execute(songplay_start_time_type)
+    if cur.fetchone()[0] != "bigint":
+        return None
+
+    cur.execute(songplay_pkey_check)
+    had_pkey = cur.fetchone()[0] > 0
+
+    cur.execute(songplay_migrate_copy)
+    cur.execute(songplay_table_drop)
+    cur.execute(songplay_table_create)
+
+    cur.execute(songplay_migrate_months)
+    for month, in cur.fetchall():
+        month = pd.Period(month, "M")
+        cur.execute(songplay_partition_create.format(partition_name(month), *month_bounds(month)))
+
+    cur.execute(songplay_migrate_insert)
+    rows = cur.rowcount
+    if had_pkey:
+        cur.execute(songplay_table_pkey)
+    conn.commit()
+
+    cur.execute("ANALYZE songplays")
+    conn.commit()
+
+    rebuild_rollups(cur, conn)
+    return rows
+
+
+def main():
+    conn = psycopg2.connect(DSN)
+    cur = conn.cursor()
+
+    rows = migrate_songplays(cur, conn)
+    if rows is None:
+        print('songplays is already migrated.')
+    else:
+        print('{} songplays migrated.'.format(rows))
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import argparse
+import psycopg2
+import pandas as pd
+from sql_queries import (songplay_partition_lock, songplay_partition_exists, songplay_partition_create,
+                         songplay_partition_select, songplay_partition_detach, songplay_partition_drop,
+                         rollup_table_create_queries, rollup_retire_queries)
+
+DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+
+
+def partition_name(month):
+    """
+    Returns the name of the songplays partition holding 'month'.
+
+    :param month: pandas Period of the month
+    """
+    return "songplays_y{:04d}m{:02d}".format(month.year, month.month)
+
+
+def month_bounds(month):
+    """
+    Returns the partition bounds of 'month': its first day and the
+    next month's.
+
+    :param month: pandas Period of the month
+    """
+    return month.start_time.date(), (month + 1).start_time.date()
+
+
+def ensure_partitions(cur, start_times, known=None):
+    """
+    Creates the monthly songplays partitions that 'start_times' fall in
+    and that do not exist yet. Creation is serialised with an advisory
+    lock so that concurrent loaders do not race to create the same
+    partition.
+
+    :param cur: DB cursor
+    :param start_times: Series of songplay start_time timestamps
+    :param known: Set of partition names already known to exist (optional),
+                  updated with the partitions found or created
+    """
+    if known is None:
+        known = set()
+
+    months = start_times.dt.to_period("M").unique()
+    missing = [month for month in months if partition_name(month) not in known]
+    if not missing:
+        return
+
+    cur.execute(songplay_partition_lock)
+    for month in sorted(missing):
+        name = partition_name(month)
+        cur.execute(songplay_partition_exists, (name,))
+        if not cur.fetchone()[0]:
+            cur.execute(songplay_partition_create.format(name, *month_bounds(month)))
+        known.add(name)
+
+
+def list_partitions(cur):
+    """
+    Returns (name, month) of the songplays partitions, oldest first.
+
+    :param cur: DB cursor
+    """
+    cur.execute(songplay_partition_select)
+    return [(name, pd.Period(name[len("songplays_y"):].replace("m", "-"), "M"))
+            for name, in cur.fetchall()]
+
+
+def retire_partitions(cur, conn, before, drop=False, concurrently=False):
+    """
+    Detaches, and optionally drops, the songplays partitions of months
+    before 'before'. Detaching a partition only updates the catalog, so
+    old data leaves the fact table without a slow DELETE; a detached
+    partition is an ordinary table that can be archived and dropped.
+    The retired months are then removed from the rollup tables, so they
+    keep counting only the songplays left.
+
+    :param cur: DB cursor
+    :param conn: Connection to DB
+    :param before: First month to keep, e.g. '2018-11'
+    :param drop: Drop the partitions after detaching them
+    :param concurrently: Detach without blocking queries on songplays
+                         (Postgres 14+); runs outside a transaction
+    :return: Names of the retired partitions
+    """
+    before = pd.Period(before, "M")
+    retired = [name for name, month in list_partitions(cur) if month < before]
+    conn.commit()
+
+    autocommit = conn.autocommit
+    conn.autocommit = concurrently
+    try:
+        for name in retired:
+            cur.execute(songplay_partition_detach.format(name, "CONCURRENTLY" if concurrently else ""))
+            if drop:
+                cur.execute(songplay_partition_drop.format(name))
+            if not concurrently:
+                conn.commit()
+    finally:
+        conn.autocommit = autocommit
+
+    if retired:
+        for query in rollup_table_create_queries:
+            cur.execute(query)
+        for query in rollup_retire_queries:
+            cur.execute(query, {"before": before.start_time.date()})
+        conn.commit()
+
+    return retired
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the monthly partitions of songplays.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="list the partitions")
+    retire = subparsers.add_parser("retire", help="detach the partitions of months before BEFORE")
+    retire.add_argument("before", help="first month to keep, e.g. 2018-11")
+    retire.add_argument("--drop", action="store_true", help="drop the partitions after detaching them")
+    retire.add_argument("--concurrently", action="store_true",
+                        help="detach without blocking queries (Postgres 14+)")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(DSN)
+    cur = conn.cursor()
+
+    if args.command == "list":
+        for name, month in list_partitions(cur):
+            print('{} {}'.format(name, month))
+    else:
+        for name in retire_partitions(cur, conn, args.before, args.drop, args.concurrently):
+            print('{} {}'.format("dropped" if args.drop else "detached", name))
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+import argparse
+import psycopg2
+from sql_queries import rollup_table_create_queries, rollup_truncate, rollup_delete_queries, rollup_rebuild_queries
+
+DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+
+
+def rebuild_rollups(cur, conn, since=None):
+    """
+    Recomputes the rollup tables from 'songplays', for backfills and for
+    loads that bypass the incremental maintenance ('etl.py --bulk-load').
+    Runs as one transaction, so dashboards never see partial rollups.
+
+    :param cur: DB cursor
+    :param conn: Connection to DB
+    :param since: First day to recompute, e.g. '2018-11-05'; rebuilds
+                  everything when None
+    """
+    for query in rollup_table_create_queries:
+        cur.execute(query)
+
+    if since is None:
+        cur.execute(rollup_truncate)
+        since = "-infinity"
+    else:
+        for query in rollup_delete_queries:
+            cur.execute(query, {"since": since})
+
+    for query in rollup_rebuild_queries:
+        cur.execute(query, {"since": since})
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the songplay rollup tables from songplays.")
+    parser.add_argument("--since", metavar="DAY",
+                        help="only recompute days from DAY (YYYY-MM-DD) on, e.g. after a backfill")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(DSN)
+    cur = conn.cursor()
+
+    rebuild_rollups(cur, conn, args.since)
+    print('rollups rebuilt{}.'.format(' from ' + args.since if args.since else ''))
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
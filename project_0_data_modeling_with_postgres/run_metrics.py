@@ -0,0 +1,209 @@
+import os
+import json
+import time
+import statistics
+from contextlib import contextmanager
+
+STAGES = ("parse", "transform", "lookup", "insert", "commit", "dedupe", "index", "rollup")
+
+
+class Stage:
+    """
+    A single timed block, 'rows' is set by the code being timed.
+    """
+
+    def __init__(self):
+        self.rows = 0
+
+
+class RunMetrics:
+    """
+    Wall time and row counts of an ETL run, per stage and per file.
+
+    Stages are recorded under the current phase (e.g. 'song_data' or
+    'log_data') so that parsing song files and parsing log files are
+    reported separately. Worker processes keep their own RunMetrics and
+    send snapshots back to be merged into the parent's.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.phase = None
+        self.stages = {}
+        self.files = []
+        self._file_stages = None
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times the enclosed block as stage 'name' of the current phase.
+
+        :param name: Stage name, one of STAGES
+        """
+        stage = Stage()
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            self.add(name, time.perf_counter() - start, stage.rows)
+
+    def add(self, name, seconds, rows=0):
+        """
+        Adds time and rows to stage 'name' of the current phase, and to
+        the file currently being processed.
+
+        :param name: Stage name
+        :param seconds: Wall time spent in the stage
+        :param rows: Number of rows handled by the stage
+        """
+        totals = self.stages.setdefault((self.phase, name), [0.0, 0])
+        totals[0] += seconds
+        totals[1] += rows
+        if self._file_stages is not None:
+            totals = self._file_stages.setdefault(name, [0.0, 0])
+            totals[0] += seconds
+            totals[1] += rows
+
+    @contextmanager
+    def file(self, paths):
+        """
+        Times the processing of a file, or batch of files, and the
+        stages run for it. 'rows' of the yielded record is set to the
+        number of rows the files produced.
+
+        :param paths: Paths of the files being processed
+        """
+        self._file_stages = {}
+        record = Stage()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            seconds = time.perf_counter() - start
+            self.files.append({"phase": self.phase,
+                               "path": paths[0],
+                               "files": len(paths),
+                               "seconds": seconds,
+                               "rows": record.rows,
+                               "stages": {name: {"seconds": s, "rows": r}
+                                          for name, (s, r) in self._file_stages.items()}})
+            self._file_stages = None
+
+    def snapshot(self):
+        """
+        Returns the recorded metrics in a picklable form and clears
+        them, for sending from a worker to the parent process.
+        """
+        data = (self.stages, self.files)
+        self.stages, self.files = {}, []
+        return data
+
+    def merge(self, data):
+        """
+        Merges a snapshot taken in a worker process.
+
+        :param data: Result of 'snapshot'
+        """
+        stages, files = data
+        for key, (seconds, rows) in stages.items():
+            totals = self.stages.setdefault(key, [0.0, 0])
+            totals[0] += seconds
+            totals[1] += rows
+        self.files.extend(files)
+
+    def slow_files(self, factor=3.0):
+        """
+        Returns the files of each phase that took more than 'factor'
+        times the phase's median time per file.
+
+        :param factor: Multiple of the median that marks an outlier
+        """
+        slow = []
+        for phase in {f["phase"] for f in self.files}:
+            files = [f for f in self.files if f["phase"] == phase]
+            median = statistics.median(f["seconds"] / f["files"] for f in files)
+            slow += [dict(f, median_seconds=median) for f in files
+                     if f["seconds"] / f["files"] > factor * median]
+        return sorted(slow, key=lambda f: f["seconds"], reverse=True)
+
+    def report(self, slow_factor=3.0):
+        """
+        Returns the run report as a dict.
+
+        :param slow_factor: Multiple of the median that marks a slow file
+        """
+        stages = []
+        for (phase, name), (seconds, rows) in sorted(self.stages.items(), key=lambda item: str(item[0])):
+            stages.append({"phase": phase,
+                           "stage": name,
+                           "seconds": seconds,
+                           "rows": rows,
+                           "rows_per_sec": rows / seconds if seconds else None})
+        return {"started": self.started,
+                "seconds": time.time() - self.started,
+                "stages": stages,
+                "files": self.files,
+                "slow_files": self.slow_files(slow_factor)}
+
+    def print_summary(self, slow_factor=3.0):
+        """
+        Prints time, rows and rows/sec per stage and the slow files.
+
+        :param slow_factor: Multiple of the median that marks a slow file
+        """
+        report = self.report(slow_factor)
+        for stage in report["stages"]:
+            print('{phase}/{stage}: {seconds:.2f}s, {rows} rows, {rate} rows/sec'.format(
+                rate='{:.0f}'.format(stage["rows_per_sec"]) if stage["rows_per_sec"] else '-', **stage))
+        for f in report["slow_files"]:
+            print('slow: {path} took {seconds:.2f}s ({files} files, median {median_seconds:.2f}s per file)'.format(**f))
+
+    def write_json(self, path, slow_factor=3.0):
+        """
+        Writes the run report as JSON.
+
+        :param path: Output file path
+        :param slow_factor: Multiple of the median that marks a slow file
+        """
+        with open(path, "w") as f:
+            json.dump(self.report(slow_factor), f, indent=2)
+
+    def write_prometheus(self, path, prefix="sparkify_etl"):
+        """
+        Writes stage totals in the Prometheus text format, for the
+        node_exporter textfile collector. The file is replaced
+        atomically so the collector never reads a partial file.
+
+        :param path: Output file path, conventionally ending in '.prom'
+        :param prefix: Metric name prefix
+        """
+        metrics = (("stage_seconds", "Wall time spent in an ETL stage.",
+                    lambda seconds, rows: seconds),
+                   ("stage_rows", "Rows handled by an ETL stage.",
+                    lambda seconds, rows: rows),
+                   ("stage_rows_per_second", "Throughput of an ETL stage.",
+                    lambda seconds, rows: rows / seconds if seconds else 0))
+        lines = []
+        for name, help_text, value in metrics:
+            lines.append('# HELP {}_{} {}'.format(prefix, name, help_text))
+            lines.append('# TYPE {}_{} gauge'.format(prefix, name))
+            for (phase, stage), totals in sorted(self.stages.items(), key=lambda item: str(item[0])):
+                lines.append('{}_{}{{phase="{}",stage="{}"}} {}'.format(prefix, name, phase, stage, value(*totals)))
+
+        lines.append('# HELP {}_files Files processed per phase.'.format(prefix))
+        lines.append('# TYPE {}_files gauge'.format(prefix))
+        for phase in sorted({f["phase"] for f in self.files}):
+            lines.append('{}_files{{phase="{}"}} {}'.format(
+                prefix, phase, sum(f["files"] for f in self.files if f["phase"] == phase)))
+
+        lines.append('# HELP {}_last_run_seconds Wall time of the last run.'.format(prefix))
+        lines.append('# TYPE {}_last_run_seconds gauge'.format(prefix))
+        lines.append('{}_last_run_seconds {}'.format(prefix, time.time() - self.started))
+
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, path)
+
+
+metrics = RunMetrics()
@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+from sql_queries import song_index_select
+
+
+def round_duration(duration):
+    """
+    Rounds durations half away from zero, matching the rounding Postgres
+    applies when storing 'songs.duration' and evaluating 'ROUND(%s)'
+    in 'song_select'.
+
+    :param duration: Scalar or array of durations in seconds
+    """
+    return np.floor(np.asarray(duration, dtype=float) + 0.5)
+
+
+class SongIndex:
+    """
+    In-memory lookup of (title, artist name, rounded duration) to
+    (song_id, artist_id), used instead of running 'song_select' once
+    per log event.
+
+    The index is loaded once from the 'songs' and 'artists' tables and
+    kept up to date as new song files are inserted. Lookups resolve a
+    whole DataFrame of events with a single join.
+    """
+
+    columns = ["title", "name", "duration"]
+
+    def __init__(self):
+        self._songs = {}
+        self._frame = None
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def load(cls, cur):
+        """
+        Builds an index from the songs and artists already in the DB.
+
+        :param cur: DB cursor
+        """
+        index = cls()
+        cur.execute(song_index_select)
+        for title, name, duration, song_id, artist_id in cur:
+            index._songs.setdefault((title, name, float(duration)), (song_id, artist_id))
+        return index
+
+    def __len__(self):
+        return len(self._songs)
+
+    def add(self, title, artist_name, duration, song_id, artist_id):
+        """
+        Adds a newly inserted song. As with 'song_select', the first
+        song seen for a key is the one that is matched.
+
+        :param title: Song title
+        :param artist_name: Artist name
+        :param duration: Song duration in seconds (unrounded)
+        :param song_id: ID of the song
+        :param artist_id: ID of the song's artist
+        """
+        key = (title, artist_name, float(round_duration(duration)))
+        if key not in self._songs:
+            self._songs[key] = (song_id, artist_id)
+            self._frame = None
+
+    def lookup(self, df):
+        """
+        Resolves song and artist IDs for a DataFrame of log events.
+
+        :param df: Log events with 'song', 'artist' and 'length' columns
+        :return: DataFrame with 'song_id' and 'artist_id' columns aligned
+                 with 'df'; unmatched events get None
+        """
+        if self._frame is None:
+            self._frame = pd.DataFrame([key + ids for key, ids in self._songs.items()],
+                                       columns=self.columns + ["song_id", "artist_id"])
+            self._frame = self._frame.astype({"duration": float})
+
+        events = pd.DataFrame({"title": df["song"].values,
+                               "name": df["artist"].values,
+                               "duration": round_duration(df["length"])})
+        matched = events.merge(self._frame, how="left", on=self.columns)
+        matched = matched[["song_id", "artist_id"]].astype(object)
+        matched = matched.where(matched.notna(), None)
+        matched.index = df.index
+
+        hits = int(matched["song_id"].notna().sum())
+        self.hits += hits
+        self.misses += len(matched) - hits
+
+        return matched
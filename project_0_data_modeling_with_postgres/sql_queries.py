@@ -5,23 +5,28 @@ user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+load_manifest_table_drop = "DROP TABLE IF EXISTS load_manifest"
+plays_by_hour_table_drop = "DROP TABLE IF EXISTS plays_by_hour"
+plays_by_user_day_table_drop = "DROP TABLE IF EXISTS plays_by_user_day"
+plays_by_song_day_table_drop = "DROP TABLE IF EXISTS plays_by_song_day"
+plays_by_level_day_table_drop = "DROP TABLE IF EXISTS plays_by_level_day"
 
 # CREATE TABLES
 
 songplay_table_create = ("""
-CREATE TABLE IF NOT EXISTS songplays (start_time bigint NOT NULL, 
-                                      user_id int NOT NULL, 
+CREATE TABLE IF NOT EXISTS songplays (start_time timestamp NOT NULL, 
+                                      user_id text NOT NULL, 
                                       level text NOT NULL, 
                                       song_id text, 
                                       artist_id text, 
                                       session_id text NOT NULL, 
                                       location text, 
-                                      user_agent text NOT NULL, 
-                                      PRIMARY KEY (start_time, user_id))
+                                      user_agent text NOT NULL)
+PARTITION BY RANGE (start_time)
 """)
 
 user_table_create = ("""
-CREATE TABLE IF NOT EXISTS users (user_id text UNIQUE PRIMARY KEY, 
+CREATE TABLE IF NOT EXISTS users (user_id text NOT NULL, 
                                   first_name text NOT NULL, 
                                   last_name text NOT NULL, 
                                   gender text NOT NULL, 
@@ -29,7 +34,7 @@ CREATE TABLE IF NOT EXISTS users (user_id text UNIQUE PRIMARY KEY,
 """)
 
 song_table_create = ("""
-CREATE TABLE IF NOT EXISTS songs (song_id text UNIQUE PRIMARY KEY, 
+CREATE TABLE IF NOT EXISTS songs (song_id text NOT NULL, 
                                   title text NOT NULL, 
                                   artist_id text NOT NULL, 
                                   year int NOT NULL, 
@@ -37,7 +42,7 @@ CREATE TABLE IF NOT EXISTS songs (song_id text UNIQUE PRIMARY KEY,
 """)
 
 artist_table_create = ("""
-CREATE TABLE IF NOT EXISTS artists (artist_id text UNIQUE PRIMARY KEY, 
+CREATE TABLE IF NOT EXISTS artists (artist_id text NOT NULL, 
                                     name text NOT NULL, 
                                     location text, 
                                     latitude decimal, 
@@ -45,7 +50,7 @@ CREATE TABLE IF NOT EXISTS artists (artist_id text UNIQUE PRIMARY KEY,
 """)
 
 time_table_create = ("""
-CREATE TABLE IF NOT EXISTS time (start_time timestamp PRIMARY KEY, 
+CREATE TABLE IF NOT EXISTS time (start_time timestamp NOT NULL, 
                                  hour int NOT NULL, 
                                  day int NOT NULL, 
                                  week int NOT NULL, 
@@ -54,6 +59,113 @@ CREATE TABLE IF NOT EXISTS time (start_time timestamp PRIMARY KEY,
                                  weekday int NOT NULL)
 """)
 
+load_manifest_table_create = ("""
+CREATE TABLE IF NOT EXISTS load_manifest (path text PRIMARY KEY, 
+                                          size bigint NOT NULL, 
+                                          mtime double precision NOT NULL, 
+                                          content_hash text NOT NULL, 
+                                          rows int NOT NULL, 
+                                          loaded_at timestamp NOT NULL DEFAULT now())
+""")
+
+# ROLLUP TABLES
+# Songplay counts for dashboards, kept up to date as songplays are loaded.
+
+plays_by_hour_table_create = ("""
+CREATE TABLE IF NOT EXISTS plays_by_hour (hour timestamp PRIMARY KEY, 
+                                          plays bigint NOT NULL)
+""")
+
+plays_by_user_day_table_create = ("""
+CREATE TABLE IF NOT EXISTS plays_by_user_day (day date NOT NULL, 
+                                              user_id text NOT NULL, 
+                                              plays bigint NOT NULL, 
+                                              PRIMARY KEY (day, user_id))
+""")
+
+plays_by_song_day_table_create = ("""
+CREATE TABLE IF NOT EXISTS plays_by_song_day (day date NOT NULL, 
+                                              song_id text NOT NULL, 
+                                              plays bigint NOT NULL, 
+                                              PRIMARY KEY (day, song_id))
+""")
+
+plays_by_level_day_table_create = ("""
+CREATE TABLE IF NOT EXISTS plays_by_level_day (day date NOT NULL, 
+                                               level text NOT NULL, 
+                                               plays bigint NOT NULL, 
+                                               PRIMARY KEY (day, level))
+""")
+
+# SONGPLAYS PARTITIONS
+# One partition per month, created by the loader as data arrives.
+
+songplay_partition_lock = "SELECT pg_advisory_xact_lock(hashtext('songplays_partitions'))"
+songplay_partition_exists = "SELECT to_regclass(%s) IS NOT NULL"
+songplay_partition_create = "CREATE TABLE IF NOT EXISTS {} PARTITION OF songplays FOR VALUES FROM ('{}') TO ('{}')"
+
+songplay_partition_select = ("""
+SELECT c.relname 
+FROM pg_inherits i 
+JOIN pg_class c ON c.oid = i.inhrelid 
+WHERE i.inhparent = 'songplays'::regclass 
+ORDER BY c.relname
+""")
+
+songplay_partition_detach = "ALTER TABLE songplays DETACH PARTITION {} {}"
+songplay_partition_drop = "DROP TABLE {}"
+
+# PRIMARY KEYS AND INDEXES
+# Created right after the tables, or after the first load of a bulk load.
+
+songplay_table_pkey = "ALTER TABLE songplays ADD PRIMARY KEY (start_time, user_id)"
+user_table_pkey = "ALTER TABLE users ADD PRIMARY KEY (user_id)"
+song_table_pkey = "ALTER TABLE songs ADD PRIMARY KEY (song_id)"
+artist_table_pkey = "ALTER TABLE artists ADD PRIMARY KEY (artist_id)"
+time_table_pkey = "ALTER TABLE time ADD PRIMARY KEY (start_time)"
+
+# song_select filters songs on title and duration and artists on name
+song_lookup_index = ("""
+CREATE INDEX IF NOT EXISTS songs_title_duration_idx 
+ON songs (title, duration) INCLUDE (song_id, artist_id)
+""")
+artist_lookup_index = "CREATE INDEX IF NOT EXISTS artists_name_idx ON artists (name)"
+
+# Rows loaded into bare tables are not deduplicated by ON CONFLICT.
+# Keep the first row per key, as ON CONFLICT DO NOTHING would have,
+# and the last row per user, as the users upsert would have.
+
+songplay_table_dedupe = ("""
+DELETE FROM songplays a USING songplays b 
+WHERE a.start_time = b.start_time AND a.user_id = b.user_id AND a.ctid > b.ctid
+""")
+user_table_dedupe = ("""
+DELETE FROM users a USING users b 
+WHERE a.user_id = b.user_id AND a.ctid < b.ctid
+""")
+song_table_dedupe = ("""
+DELETE FROM songs a USING songs b 
+WHERE a.song_id = b.song_id AND a.ctid > b.ctid
+""")
+artist_table_dedupe = ("""
+DELETE FROM artists a USING artists b 
+WHERE a.artist_id = b.artist_id AND a.ctid > b.ctid
+""")
+time_table_dedupe = ("""
+DELETE FROM time a USING time b 
+WHERE a.start_time = b.start_time AND a.ctid > b.ctid
+""")
+
+analyze_tables = "ANALYZE songplays, users, songs, artists, time"
+
+primary_key_check = ("""
+SELECT count(*) 
+FROM pg_constraint 
+WHERE contype = 'p' 
+AND conrelid IN ('songplays'::regclass, 'users'::regclass, 'songs'::regclass, 
+                 'artists'::regclass, 'time'::regclass)
+""")
+
 # INSERT RECORDS
 
 songplay_table_insert = ("""
@@ -66,6 +178,7 @@ INSERT INTO songplays (start_time,
                        location, 
                        user_agent)
 VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+ON CONFLICT DO NOTHING
 """)
 
 user_table_insert = ("""
@@ -114,6 +227,264 @@ VALUES (%s, %s, %s, %s, %s, %s, %s)
 ON CONFLICT DO NOTHING
 """)
 
+song_table_batch_insert = ("""
+INSERT INTO songs (song_id, 
+                   title, 
+                   artist_id, 
+                   year, 
+                   duration)
+VALUES %s
+ON CONFLICT DO NOTHING
+""")
+
+artist_table_batch_insert = ("""
+INSERT INTO artists (artist_id, 
+                     name, 
+                     location, 
+                     latitude, 
+                     longitude)
+VALUES %s
+ON CONFLICT DO NOTHING
+""")
+
+# STAGING TABLES (bulk load)
+
+time_staging_create = "CREATE TEMP TABLE IF NOT EXISTS time_staging (LIKE time)"
+user_staging_create = "CREATE TEMP TABLE IF NOT EXISTS user_staging (LIKE users)"
+songplay_staging_create = "CREATE TEMP TABLE IF NOT EXISTS songplay_staging (LIKE songplays)"
+
+staging_copy = "COPY {} FROM STDIN WITH (FORMAT csv)"
+staging_truncate = "TRUNCATE time_staging, user_staging, songplay_staging"
+
+# MERGE STAGED RECORDS
+
+time_table_merge = ("""
+INSERT INTO time (start_time, 
+                  hour, 
+                  day, 
+                  week, 
+                  month, 
+                  year, 
+                  weekday)
+SELECT start_time, hour, day, week, month, year, weekday
+FROM time_staging
+ORDER BY start_time
+ON CONFLICT DO NOTHING
+""")
+
+# users has no primary key during a bulk load, rows are deduplicated afterwards
+user_table_append = ("""
+INSERT INTO users (user_id, 
+                   first_name, 
+                   last_name, 
+                   gender, 
+                   level)
+SELECT user_id, first_name, last_name, gender, level
+FROM user_staging
+""")
+
+user_table_merge = ("""
+INSERT INTO users (user_id, 
+                   first_name, 
+                   last_name, 
+                   gender, 
+                   level)
+SELECT user_id, first_name, last_name, gender, level
+FROM user_staging
+ORDER BY user_id
+ON CONFLICT (user_id) DO UPDATE
+SET first_name = excluded.first_name,
+    last_name = excluded.last_name,
+    gender = excluded.gender,
+    level = excluded.level
+""")
+
+songplay_table_merge = ("""
+INSERT INTO songplays (start_time, 
+                       user_id, 
+                       level, 
+                       song_id, 
+                       artist_id, 
+                       session_id, 
+                       location, 
+                       user_agent)
+SELECT start_time, user_id, level, song_id, artist_id, session_id, location, user_agent
+FROM songplay_staging
+ORDER BY start_time, user_id
+ON CONFLICT DO NOTHING
+""")
+
+# MAINTAIN ROLLUPS
+# The songplays actually inserted by a statement (not those skipped as
+# duplicates) are added to the rollups in the same statement.
+
+songplay_rollup_update = ("""
+WITH delta AS ({}
+               RETURNING start_time, user_id, level, song_id),
+by_hour AS (INSERT INTO plays_by_hour (hour, plays)
+            SELECT date_trunc('hour', start_time), count(*) FROM delta 
+            GROUP BY 1 ORDER BY 1
+            ON CONFLICT (hour) DO UPDATE SET plays = plays_by_hour.plays + excluded.plays),
+by_user_day AS (INSERT INTO plays_by_user_day (day, user_id, plays)
+                SELECT start_time::date, user_id, count(*) FROM delta 
+                GROUP BY 1, 2 ORDER BY 1, 2
+                ON CONFLICT (day, user_id) DO UPDATE SET plays = plays_by_user_day.plays + excluded.plays),
+by_song_day AS (INSERT INTO plays_by_song_day (day, song_id, plays)
+                SELECT start_time::date, song_id, count(*) FROM delta 
+                WHERE song_id IS NOT NULL
+                GROUP BY 1, 2 ORDER BY 1, 2
+                ON CONFLICT (day, song_id) DO UPDATE SET plays = plays_by_song_day.plays + excluded.plays),
+by_level_day AS (INSERT INTO plays_by_level_day (day, level, plays)
+                 SELECT start_time::date, level, count(*) FROM delta 
+                 GROUP BY 1, 2 ORDER BY 1, 2
+                 ON CONFLICT (day, level) DO UPDATE SET plays = plays_by_level_day.plays + excluded.plays)
+SELECT count(*) FROM delta
+""")
+
+songplay_table_insert_rollup = songplay_rollup_update.format(songplay_table_insert.strip())
+songplay_table_merge_rollup = songplay_rollup_update.format(songplay_table_merge.strip())
+
+# REBUILD ROLLUPS
+# From songplays, in full or from a given day on.
+
+rollup_truncate = "TRUNCATE plays_by_hour, plays_by_user_day, plays_by_song_day, plays_by_level_day"
+
+plays_by_hour_delete = "DELETE FROM plays_by_hour WHERE hour >= %(since)s"
+plays_by_user_day_delete = "DELETE FROM plays_by_user_day WHERE day >= %(since)s"
+plays_by_song_day_delete = "DELETE FROM plays_by_song_day WHERE day >= %(since)s"
+plays_by_level_day_delete = "DELETE FROM plays_by_level_day WHERE day >= %(since)s"
+
+# Counts of retired months, before the first month kept
+plays_by_hour_retire = "DELETE FROM plays_by_hour WHERE hour < %(before)s"
+plays_by_user_day_retire = "DELETE FROM plays_by_user_day WHERE day < %(before)s"
+plays_by_song_day_retire = "DELETE FROM plays_by_song_day WHERE day < %(before)s"
+plays_by_level_day_retire = "DELETE FROM plays_by_level_day WHERE day < %(before)s"
+
+plays_by_hour_rebuild = ("""
+INSERT INTO plays_by_hour (hour, plays)
+SELECT date_trunc('hour', start_time), count(*) 
+FROM songplays 
+WHERE start_time >= %(since)s
+GROUP BY 1
+""")
+
+plays_by_user_day_rebuild = ("""
+INSERT INTO plays_by_user_day (day, user_id, plays)
+SELECT start_time::date, user_id, count(*) 
+FROM songplays 
+WHERE start_time >= %(since)s
+GROUP BY 1, 2
+""")
+
+plays_by_song_day_rebuild = ("""
+INSERT INTO plays_by_song_day (day, song_id, plays)
+SELECT start_time::date, song_id, count(*) 
+FROM songplays 
+WHERE start_time >= %(since)s AND song_id IS NOT NULL
+GROUP BY 1, 2
+""")
+
+plays_by_level_day_rebuild = ("""
+INSERT INTO plays_by_level_day (day, level, plays)
+SELECT start_time::date, level, count(*) 
+FROM songplays 
+WHERE start_time >= %(since)s
+GROUP BY 1, 2
+""")
+
+# LOAD MANIFEST
+
+load_manifest_select = ("""
+SELECT path, size, mtime, content_hash 
+FROM load_manifest
+""")
+
+load_manifest_upsert = ("""
+INSERT INTO load_manifest (path, 
+                           size, 
+                           mtime, 
+                           content_hash, 
+                           rows)
+VALUES %s
+ON CONFLICT (path) DO UPDATE
+SET size = excluded.size,
+    mtime = excluded.mtime,
+    content_hash = excluded.content_hash,
+    rows = excluded.rows,
+    loaded_at = now()
+""")
+
+load_manifest_touch = ("""
+UPDATE load_manifest 
+SET size = %s, 
+    mtime = %s
+WHERE path = %s
+""")
+
+# MIGRATE SONGPLAYS KEYS
+# start_time from bigint epoch milliseconds to timestamp and user_id
+# from int to text, matching the 'time' and 'users' keys.
+
+songplay_start_time_type = ("""
+SELECT data_type 
+FROM information_schema.columns 
+WHERE table_name = 'songplays' AND column_name = 'start_time'
+""")
+
+songplay_pkey_check = ("""
+SELECT count(*) 
+FROM pg_constraint 
+WHERE contype = 'p' AND conrelid = 'songplays'::regclass
+""")
+
+songplay_migrate_copy = ("""
+CREATE TEMP TABLE songplay_migrate ON COMMIT DROP AS 
+SELECT timestamp 'epoch' + start_time * interval '1 millisecond' AS start_time, 
+       user_id::text AS user_id, level, song_id, artist_id, session_id, location, user_agent
+FROM songplays
+""")
+
+songplay_migrate_months = ("""
+SELECT DISTINCT date_trunc('month', start_time) 
+FROM songplay_migrate
+""")
+
+songplay_migrate_insert = ("""
+INSERT INTO songplays (start_time, 
+                       user_id, 
+                       level, 
+                       song_id, 
+                       artist_id, 
+                       session_id, 
+                       location, 
+                       user_agent)
+SELECT start_time, user_id, level, song_id, artist_id, session_id, location, user_agent
+FROM songplay_migrate
+ORDER BY start_time, user_id
+""")
+
+# SYNC USER LEVELS
+
+user_level_sync = ("""
+UPDATE users 
+SET level = latest.level
+FROM (SELECT DISTINCT ON (user_id) user_id, level
+      FROM songplays
+      ORDER BY user_id, start_time DESC) AS latest
+WHERE users.user_id = latest.user_id
+AND users.level <> latest.level
+""")
+
+# FIND LOADED TIMESTAMPS
+
+time_latest_select = "SELECT max(start_time) FROM time"
+
+time_range_select = ("""
+SELECT start_time 
+FROM time 
+WHERE start_time BETWEEN %s AND %s
+""")
+
 # FIND SONGS
 song_select = ("""
 SELECT song_id, artists.artist_id 
@@ -124,7 +495,20 @@ AND artists.name=%s
 AND duration=ROUND(%s)
 """)
 
+song_index_select = ("""
+SELECT title, artists.name, duration, song_id, artists.artist_id 
+FROM songs 
+JOIN artists ON songs.artist_id=artists.artist_id
+""")
+
 # QUERY LISTS
 
-create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
+rollup_table_create_queries = [plays_by_hour_table_create, plays_by_user_day_table_create, plays_by_song_day_table_create, plays_by_level_day_table_create]
+create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, load_manifest_table_create] + rollup_table_create_queries
+drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, load_manifest_table_drop, plays_by_hour_table_drop, plays_by_user_day_table_drop, plays_by_song_day_table_drop, plays_by_level_day_table_drop]
+staging_table_create_queries = [time_staging_create, user_staging_create, songplay_staging_create]
+dedupe_table_queries = [songplay_table_dedupe, user_table_dedupe, song_table_dedupe, artist_table_dedupe, time_table_dedupe]
+rollup_delete_queries = [plays_by_hour_delete, plays_by_user_day_delete, plays_by_song_day_delete, plays_by_level_day_delete]
+rollup_retire_queries = [plays_by_hour_retire, plays_by_user_day_retire, plays_by_song_day_retire, plays_by_level_day_retire]
+rollup_rebuild_queries = [plays_by_hour_rebuild, plays_by_user_day_rebuild, plays_by_song_day_rebuild, plays_by_level_day_rebuild]
+create_index_queries = [songplay_table_pkey, user_table_pkey, song_table_pkey, artist_table_pkey, time_table_pkey, song_lookup_index, artist_lookup_index]
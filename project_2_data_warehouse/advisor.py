@@ -0,0 +1,348 @@
+import os
+import re
+import math
+import zlib
+import struct
+import argparse
+import configparser
+from datetime import datetime, timedelta
+from collections import Counter
+import psycopg2
+from sql_queries import (staging_events_table_create, staging_songs_table_create, songplay_table_create,
+                         user_table_create, song_table_create, artist_table_create, time_table_create,
+                         insert_table_steps, merge_table_steps)
+import staging
+
+# Tables to advise on and the columns their rows could be distributed on:
+# the keys the loads partition, join or delete by. The staging tables can
+# also be sampled from a local extract, the others only from the database.
+STAGING_TABLES = {"staging_events": (staging_events_table_create, ["userId", "sessionId"]),
+                  "staging_songs": (staging_songs_table_create, ["song_id", "artist_id"])}
+TABLES = dict(STAGING_TABLES,
+              songplays=(songplay_table_create, ["user_id", "song_id"]),
+              users=(user_table_create, []),
+              songs=(song_table_create, ["song_id", "artist_id"]),
+              artists=(artist_table_create, []),
+              time=(time_table_create, []))
+
+# Text columns get this width whatever the sample holds; only columns
+# whose sampled values come near it are sized from the sample
+VARCHAR_WIDTH = 256
+
+# Bytes per value of fixed width types, for the storage estimates
+TYPE_WIDTHS = {"SMALLINT": 2, "INTEGER": 4, "BIGINT": 8, "DOUBLE PRECISION": 8, "FLOAT": 8, "TIMESTAMP": 8,
+               "DECIMAL": 8}
+
+COLUMN = re.compile(r"^\s*(\w+)\s+(\w+(?:\s+PRECISION)?(?:\(\d+(?:,\s*\d+)?\))?)(.*?),?\s*$", re.IGNORECASE)
+INT = re.compile(r"^-?\d+$")
+FLOAT = re.compile(r"^-?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?$")
+
+
+def declared_columns(create_sql):
+    """
+    Parses the column definitions of a CREATE TABLE statement.
+
+    :param create_sql: CREATE TABLE statement from sql_queries.py
+    :return: List of (name, type, rest of the definition)
+    """
+    body = create_sql[create_sql.index("(") + 1:create_sql.rindex(")")]
+    columns = []
+    for line in body.splitlines():
+        match = COLUMN.match(line)
+        if match:
+            columns.append((match.group(1), match.group(2).upper(), match.group(3).strip()))
+    return columns
+
+
+def sample_local(local_dir, limit):
+    """
+    Reads up to 'limit' rows per staging table from a local extract,
+    shaped as the COPYs would stage them.
+
+    :param local_dir: directory holding song_data and log_data
+    :param limit: maximum rows per table
+    :return: Dict of table name to list of row dicts
+    """
+    events = []
+    for paths in staging.list_local_log_days(os.path.join(local_dir, "log_data")).values():
+        for path in paths:
+            for record in staging.read_json_records(path):
+                record["ts"] = str(datetime(1970, 1, 1) + timedelta(milliseconds=record["ts"]))
+                events.append(record)
+        if len(events) >= limit:
+            break
+
+    songs = []
+    for root, _, files in sorted(os.walk(os.path.join(local_dir, "song_data"))):
+        for name in sorted(files):
+            if name.endswith(".json") and len(songs) < limit:
+                songs += staging.read_json_records(os.path.join(root, name))
+
+    return {"staging_events": events[:limit], "staging_songs": songs[:limit]}
+
+
+def sample_tables(cur, limit):
+    """
+    Reads up to 'limit' rows of each table.
+
+    :param cur: cursor object for redshift
+    :param limit: maximum rows per table
+    :return: Dict of table name to list of row dicts
+    """
+    samples = {}
+    for table in TABLES:
+        cur.execute("SELECT * FROM {} LIMIT {:d}".format(table, limit))
+        names = [column[0] for column in cur.description]
+        samples[table] = [dict(zip(names, row)) for row in cur.fetchall()]
+    return samples
+
+
+def profile_column(values):
+    """
+    Measures a column's sampled values.
+
+    :param values: Sampled values as strings, None for NULL
+    :return: Dict of count, nulls, distinct, max_bytes, avg_bytes, kind
+             ('int', 'float' or 'text'), min and max (numeric columns) and
+             top_share (share of the most common value)
+    """
+    present = [value for value in values if value is not None]
+    counts = Counter(present)
+    widths = [len(value.encode("utf-8")) for value in present]
+    profile = {"count": len(values),
+               "nulls": len(values) - len(present),
+               "distinct": len(counts),
+               "max_bytes": max(widths, default=0),
+               "avg_bytes": sum(widths) / len(widths) if widths else 0.0,
+               "top_share": counts.most_common(1)[0][1] / len(present) if present else 0.0,
+               "kind": "text"}
+
+    if present and all(INT.match(value) for value in present):
+        numbers = [int(value) for value in present]
+        profile.update(kind="int", min=min(numbers), max=max(numbers))
+    elif present and all(FLOAT.match(value) for value in present):
+        numbers = [float(value) for value in present]
+        if all(number.is_integer() for number in numbers):
+            profile.update(kind="int", min=int(min(numbers)), max=int(max(numbers)))
+        else:
+            profile.update(kind="float", min=min(numbers), max=max(numbers))
+    return profile
+
+
+def recommend_type(profile, declared):
+    """
+    Returns a type for a column that does not depend on the sample holding
+    the extremes of the data: INTEGER for numeric text (BIGINT when the
+    sampled values reach past half its range), DOUBLE PRECISION for
+    decimal text, VARCHAR(256) for other text and the declared type
+    otherwise. Text values longer than half that width size the column to
+    twice the longest sampled value. Such a type is sample-bound, as is a
+    numeric type for a text column: a longer or non-numeric value (a blank
+    userId, say) would fail the COPY.
+
+    :param profile: Result of 'profile_column'
+    :param declared: Declared column type
+    :return: (type, whether the type is sample-bound)
+    """
+    if declared in ("TIMESTAMP", "FLOAT", "DOUBLE PRECISION") or declared.startswith("DECIMAL"):
+        return declared, False
+    numeric_text = declared.startswith("VARCHAR")
+    if profile["kind"] == "int":
+        if -2 ** 30 <= profile["min"] and profile["max"] < 2 ** 30:
+            return "INTEGER", numeric_text
+        return "BIGINT", numeric_text
+    if profile["kind"] == "float":
+        return "DOUBLE PRECISION", numeric_text
+    if declared.startswith("VARCHAR"):
+        if profile["max_bytes"] * 2 <= VARCHAR_WIDTH:
+            return "VARCHAR({})".format(VARCHAR_WIDTH), False
+        return "VARCHAR({})".format(min(65535, 2 ** math.ceil(math.log2(profile["max_bytes"] * 2)))), True
+    return declared, False
+
+
+def recommend_encoding(profile, column_type, is_sortkey):
+    """
+    Picks a Redshift column encoding. Sort key columns stay RAW so zone
+    maps can skip blocks; low-cardinality text uses BYTEDICT, numbers and
+    timestamps AZ64 and other text ZSTD.
+
+    :param profile: Result of 'profile_column'
+    :param column_type: Recommended column type
+    :param is_sortkey: Whether the column is the sort key
+    """
+    if is_sortkey:
+        return "RAW"
+    if column_type.split("(")[0] in TYPE_WIDTHS:
+        return "AZ64"
+    if profile["distinct"] <= 255:
+        return "BYTEDICT"
+    return "ZSTD"
+
+
+def choose_keys(profiles, candidates, declared_sortkey=None, slices=16):
+    """
+    Picks the distribution and sort keys of a table. The distribution key
+    is the candidate with the most distinct values whose most common value
+    holds less than one slice's share of the rows; without one the table
+    is distributed EVEN, or ALL when it has no candidates. The sort key is
+    the first timestamp column, otherwise the distribution key, otherwise
+    the declared sort key.
+
+    :param profiles: Dict of column name to (profile, type, sample-bound)
+    :param candidates: Columns the table could be distributed on
+    :param declared_sortkey: Sort key column of the current DDL (optional)
+    :param slices: Number of slices rows are spread over
+    :return: (distkey or None, sortkey or None)
+    """
+    usable = [name for name in candidates
+              if name in profiles and profiles[name][0]["top_share"] < 1.0 / slices
+              and profiles[name][0]["nulls"] == 0]
+    distkey = max(usable, key=lambda name: profiles[name][0]["distinct"], default=None)
+    sortkey = next((name for name, (_, column_type, _) in profiles.items() if column_type == "TIMESTAMP"),
+                   distkey or declared_sortkey)
+    return distkey, sortkey
+
+
+def encoded_bytes(values, column_type):
+    """
+    Estimates the stored size of a column from its sampled values,
+    compressed in load order with zlib standing in for the column encoding.
+
+    :param values: Sampled values as strings, None for NULL
+    :param column_type: Column type the values are stored as
+    """
+    base = column_type.split("(")[0]
+    present = [value for value in values if value is not None]
+    if base in ("SMALLINT", "INTEGER", "BIGINT"):
+        data = struct.pack("<{}q".format(len(present)), *(int(float(value)) for value in present))
+    elif base in ("DOUBLE PRECISION", "FLOAT"):
+        data = struct.pack("<{}d".format(len(present)), *(float(value) for value in present))
+    else:
+        data = "\n".join(present).encode("utf-8")
+    return len(zlib.compress(data, 6))
+
+
+def raw_bytes(profile, column_type):
+    """
+    Estimates the uncompressed size of a column's sampled values.
+
+    :param profile: Result of 'profile_column'
+    :param column_type: Column type the values are stored as
+    """
+    width = TYPE_WIDTHS.get(column_type.split("(")[0])
+    present = profile["count"] - profile["nulls"]
+    if width:
+        return width * present
+    # variable length values carry a 4 byte length
+    return (profile["avg_bytes"] + 4) * present
+
+
+def loaded_columns():
+    """
+    Returns the lower-cased names the insert and merge statements mention,
+    the staging columns the loads scan.
+    """
+    sql = " ".join(query for _, query, _ in insert_table_steps + merge_table_steps)
+    return {word.lower() for word in re.findall(r"\w+", sql)}
+
+
+def advise(table, rows):
+    """
+    Profiles a table's sampled rows and builds its recommended DDL.
+
+    :param table: Table name, a key of TABLES
+    :param rows: Sampled rows as dicts
+    :return: (DDL, summary dict with 'rows', 'storage_before', 'storage_after',
+             'scan_before' and 'scan_after' in bytes per row and 'sample_bound',
+             the columns whose type only holds values as long as the sampled ones)
+    """
+    create_sql, candidates = TABLES[table]
+    columns = declared_columns(create_sql)
+    scanned = loaded_columns()
+    declared_sortkey = next((name for name, _, rest in columns if "SORTKEY" in rest.upper()), None)
+
+    profiles, values = {}, {}
+    for name, declared, rest in columns:
+        if "IDENTITY" in rest.upper():
+            continue
+        keys = {key.lower(): key for key in (rows[0] if rows else {})}
+        values[name] = [None if row.get(keys.get(name.lower())) is None else str(row[keys[name.lower()]])
+                        for row in rows]
+        profile = profile_column(values[name])
+        profiles[name] = (profile, *recommend_type(profile, declared))
+
+    distkey, sortkey = choose_keys(profiles, candidates, declared_sortkey)
+
+    n = max(len(rows), 1)
+    summary = {"rows": len(rows), "storage_before": 0.0, "storage_after": 0.0, "scan_before": 0.0, "scan_after": 0.0,
+               "sample_bound": [name for name, (_, _, bound) in profiles.items() if bound]}
+    lines, comments = [], {}
+    for name, declared, rest in columns:
+        constraint = re.sub(r"\b(?:SORTKEY|DISTKEY)\b", "", rest, flags=re.IGNORECASE).strip()
+        if name not in profiles:
+            lines.append("    {:<16} {} ENCODE AZ64".format(name, " ".join((declared, constraint))))
+            continue
+
+        profile, column_type, bound = profiles[name]
+        encoding = recommend_encoding(profile, column_type, name == sortkey)
+        keys = " ".join(key for key, column in (("DISTKEY", distkey), ("SORTKEY", sortkey)) if name == column)
+        lines.append("    {:<16} {:<18} {:<8} ENCODE {:<8} {}".format(name, column_type, constraint, encoding, keys).rstrip())
+        if bound:
+            comments[len(lines) - 1] = " -- typed from the sample"
+
+        before = raw_bytes(profile, declared) / n
+        after = (raw_bytes(profile, column_type) if encoding == "RAW" else encoded_bytes(values[name], column_type)) / n
+        summary["storage_before"] += before
+        summary["storage_after"] += after
+        if name.lower() in scanned:
+            summary["scan_before"] += before
+            summary["scan_after"] += after
+
+    ddl = "CREATE TABLE IF NOT EXISTS {}\n(\n{}\n){};".format(
+        table, "\n".join(line + ("," if i < len(lines) - 1 else "") + comments.get(i, "")
+                          for i, line in enumerate(lines)), "" if distkey else " DISTSTYLE ALL" if not candidates else " DISTSTYLE EVEN")
+    return ddl, summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Recommend column types, encodings and distribution and sort keys for the warehouse tables.")
+    parser.add_argument("--local", metavar="DIR",
+                        help="sample song_data and log_data in DIR for the staging tables, "
+                             "instead of the tables of the database given in dwh.cfg")
+    parser.add_argument("--sample", type=int, default=100000, help="rows sampled per table")
+    parser.add_argument("--output", metavar="PATH", help="write the recommended DDL to PATH")
+    args = parser.parse_args()
+
+    if args.local:
+        samples = sample_local(args.local, args.sample)
+    else:
+        config = configparser.ConfigParser()
+        config.read('dwh.cfg')
+        conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+        samples = sample_tables(conn.cursor(), args.sample)
+        conn.close()
+
+    statements = []
+    for table, rows in samples.items():
+        ddl, summary = advise(table, rows)
+        statements.append(ddl)
+        print(ddl)
+        print('-- {}: {} rows sampled, storage {:.0f} -> {:.0f} bytes/row ({:.0%} saved), '
+              'scanned by the loads {:.0f} -> {:.0f} bytes/row ({:.0%} saved)\n'.format(
+                  table, summary["rows"],
+                  summary["storage_before"], summary["storage_after"],
+                  1 - summary["storage_after"] / summary["storage_before"] if summary["storage_before"] else 0,
+                  summary["scan_before"], summary["scan_after"],
+                  1 - summary["scan_after"] / summary["scan_before"] if summary["scan_before"] else 0))
+        if summary["sample_bound"]:
+            print('-- {}: {} typed from the sample; if other values can arrive, keep them VARCHAR '
+                  'or, for text widths, load with TRUNCATECOLUMNS\n'.format(table, ", ".join(summary["sample_bound"])))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write("\n\n".join(statements) + "\n")
+
+
+if __name__ == "__main__":
+    main()
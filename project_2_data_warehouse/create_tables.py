@@ -1,6 +1,8 @@
+import argparse
 import configparser
 import psycopg2
 from sql_queries import create_table_queries, drop_table_queries
+from dialect import to_postgres
 
 
 def drop_tables(cur, conn):
@@ -14,18 +16,24 @@ def drop_tables(cur, conn):
         conn.commit()
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, local=False):
     """
     Creates the tables specified in create_table_queries
     :param cur: cursor object for redshift
     :param conn: connection object for redshift
+    :param local: translate the DDL for a Postgres stand-in
     """
     for query in create_table_queries:
-        cur.execute(query)
+        cur.execute(to_postgres(query) if local else query)
         conn.commit()
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Drop and create the Sparkify warehouse tables.")
+    parser.add_argument("--local", action="store_true",
+                        help="create the tables in a local Postgres given in dwh.cfg instead of Redshift")
+    args = parser.parse_args()
+
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
 
@@ -33,7 +41,7 @@ def main():
     cur = conn.cursor()
 
     drop_tables(cur, conn)
-    create_tables(cur, conn)
+    create_tables(cur, conn, args.local)
 
     conn.close()
 
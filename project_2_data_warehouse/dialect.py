@@ -0,0 +1,37 @@
+import re
+
+# (pattern, replacement) pairs turning the Redshift SQL in sql_queries.py
+# into SQL a local Postgres accepts. Distribution, sort keys and column
+# encodings have no Postgres equivalent and are dropped.
+POSTGRES_REWRITES = [
+    (r"\bIDENTITY\s*\(\s*0\s*,\s*1\s*\)", "GENERATED BY DEFAULT AS IDENTITY (START 0 MINVALUE 0)"),
+    (r"\b(?:COMPOUND\s+|INTERLEAVED\s+)?SORTKEY\s*\([^)]*\)", ""),
+    (r"\bDISTKEY\s*\([^)]*\)", ""),
+    (r"\bDISTSTYLE\s+(?:ALL|EVEN|KEY|AUTO)\b", ""),
+    (r"\b(?:SORTKEY|DISTKEY)\b", ""),
+    (r"\bENCODE\s+\w+", ""),
+    (r"\bdayofweek\b", "dow"),
+    (r"\bGETDATE\(\)", "now()"),
+]
+
+
+def to_postgres(query):
+    """
+    Translates a Redshift statement into the Postgres dialect, for
+    running the pipeline against a local Postgres stand-in.
+
+    :param query: Redshift SQL statement
+    :return: Equivalent Postgres SQL statement
+    """
+    for pattern, replacement in POSTGRES_REWRITES:
+        query = re.sub(pattern, replacement, query, flags=re.IGNORECASE)
+    return query
+
+
+def to_postgres_steps(steps):
+    """
+    Translates the statements of a list of (name, query, dependencies) steps.
+
+    :param steps: Steps as run by 'scheduler.run_steps'
+    """
+    return [(name, to_postgres(query), deps) for name, query, deps in steps]
@@ -1,42 +1,145 @@
+import os
+import argparse
 import configparser
-import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
+from datetime import datetime
+from psycopg2.pool import ThreadedConnectionPool
+from sql_queries import (copy_table_steps, staging_key_steps, insert_table_steps, merge_table_steps,
+                         high_water_select, staging_truncate_queries)
+from scheduler import run_steps, print_report
+from dialect import to_postgres_steps
+import staging
 
 
-def load_staging_tables(cur, conn):
+def load_staging_tables(pool, workers=4, days=None):
     """
-    Copies S3 bucket data into Redshift staging tables
-    :param cur: cursor object for redshift
-    :param conn: connection object for redshift
+    Copies S3 bucket data into Redshift staging tables, running the
+    COPYs concurrently
+    :param pool: connection pool for redshift
+    :param workers: maximum number of COPYs running at once
+    :param days: days of log data to copy, all log data when None
     """
-    for query in copy_table_queries:
-        cur.execute(query)
+    steps = copy_table_steps if days is None else staging.s3_copy_steps(days)
+    timings = run_steps(steps, pool, workers)
+    print_report(steps, timings)
+
+
+def load_local_staging_tables(pool, local_dir, days=None, workers=4):
+    """
+    Loads song and log data from a local directory into the staging
+    tables of a Postgres stand-in
+    :param pool: connection pool for postgres
+    :param local_dir: directory holding song_data and log_data
+    :param days: days of log data to load, all log data when None
+    :param workers: maximum number of statements running at once
+    """
+    log_days = staging.list_local_log_days(os.path.join(local_dir, "log_data"))
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as cur:
+            staging.copy_local_songs(cur, os.path.join(local_dir, "song_data"))
+            staging.copy_local_events(cur, [path for day in sorted(days or log_days) for path in log_days[day]])
         conn.commit()
+    finally:
+        pool.putconn(conn)
+
+    steps = to_postgres_steps(staging_key_steps)
+    timings = run_steps(steps, pool, workers)
+    print_report(steps, timings)
+
+
+def insert_tables(pool, workers=4, local=False):
+    """
+    Inserts data from staging tables into dimension and fact tables,
+    running each insert as soon as the tables it reads are loaded
+    :param pool: connection pool for redshift
+    :param workers: maximum number of inserts running at once
+    :param local: translate the statements for a Postgres stand-in
+    """
+    steps = to_postgres_steps(insert_table_steps) if local else insert_table_steps
+    timings = run_steps(steps, pool, workers)
+    print_report(steps, timings)
 
 
-def insert_tables(cur, conn):
+def merge_tables(pool, workers=4, local=False):
     """
-    Inserts data from staging tables into dimension and fact tables.
-    :param cur: cursor object for redshift
-    :param conn: connection object for redshift
+    Merges the staged rows into the dimension and fact tables, replacing
+    rows with the same keys, then advances the high-water mark and empties
+    the staging tables
+    :param pool: connection pool for redshift
+    :param workers: maximum number of merges running at once
+    :param local: translate the statements for a Postgres stand-in
     """
-    for query in insert_table_queries:
-        cur.execute(query)
+    steps = to_postgres_steps(merge_table_steps) if local else merge_table_steps
+    timings = run_steps(steps, pool, workers)
+    print_report(steps, timings)
+
+
+def new_log_days(pool, local_dir=None, until=None):
+    """
+    Returns the days of log data after the stored high-water mark
+    :param pool: connection pool for redshift
+    :param local_dir: directory holding log_data, S3 is listed when None
+    :param until: last day to load (optional)
+    """
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(high_water_select)
+            row = cur.fetchone()
+            # an incremental run starts from empty staging tables, even after a failed run
+            for query in staging_truncate_queries:
+                cur.execute(query)
         conn.commit()
+    finally:
+        pool.putconn(conn)
+
+    if local_dir:
+        days = staging.list_local_log_days(os.path.join(local_dir, "log_data"))
+    else:
+        days = staging.list_s3_log_days()
+    return staging.new_log_days(days, row[0] if row else None, until)
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Load the Sparkify data from S3 into Redshift.")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="statements run concurrently, each on its own connection (1 runs them in order)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only load log days after the stored high-water mark and merge them into the tables; "
+                             "song_data is still copied in full and every song and artist replaced")
+    parser.add_argument("--until", type=lambda day: datetime.strptime(day, "%Y-%m-%d").date(),
+                        help="last log day (YYYY-MM-DD) an incremental run loads")
+    parser.add_argument("--local", metavar="DIR",
+                        help="load song_data and log_data from DIR into a local Postgres "
+                             "given in dwh.cfg, instead of from S3 into Redshift")
+    args = parser.parse_args()
+
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
-    cur = conn.cursor()
-    
-    load_staging_tables(cur, conn)
-    insert_tables(cur, conn)
+    pool = ThreadedConnectionPool(1, args.workers, "host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+
+    days = None
+    if args.incremental:
+        days = new_log_days(pool, args.local, args.until)
+        if not days:
+            print('No new log data.')
+            pool.closeall()
+            return
+        print('Loading log data from {} to {}, and all song data.'.format(days[0], days[-1]))
+
+    if args.local:
+        load_local_staging_tables(pool, args.local, days, args.workers)
+    else:
+        load_staging_tables(pool, args.workers, days)
+
+    if args.incremental:
+        merge_tables(pool, args.workers, args.local is not None)
+    else:
+        insert_tables(pool, args.workers, args.local is not None)
 
-    conn.close()
+    pool.closeall()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,174 @@
+import re
+import sys
+import json
+import argparse
+import configparser
+import psycopg2
+from sql_queries import staging_key_steps, insert_table_steps, merge_table_steps, analytic_queries
+from dialect import to_postgres
+
+# Plan steps that move rows between slices on Redshift
+REDISTRIBUTION = re.compile(r"\bDS_DIST_(?:INNER|OUTER|BOTH|ALL_INNER)\b|\bDistribute\b")
+BROADCAST = re.compile(r"\bDS_BCAST_INNER\b|\bBroadcast\b")
+PLAN_NODE = re.compile(r"^\s*(?:->\s*)?(?:XN\s+)?(?P<node>[A-Za-z][^(]*?)\s+\(cost=[^)]*\brows=(?P<rows>\d+)")
+EXPLAINABLE = re.compile(r"^\s*(?:--[^\n]*\n\s*)*(?:SELECT|INSERT|UPDATE|DELETE|WITH)\b", re.IGNORECASE)
+
+
+def split_statements(name, query):
+    """
+    Splits a (possibly multi-statement) query into the statements that
+    EXPLAIN accepts, named 'name', or 'name.1', 'name.2', ... when the
+    query holds several.
+
+    :param name: Name of the query
+    :param query: SQL text
+    """
+    statements = [statement for statement in query.split(";") if EXPLAINABLE.match(statement)]
+    if len(statements) == 1:
+        return [(name, statements[0])]
+    return [("{}.{}".format(name, i), statement) for i, statement in enumerate(statements, 1)]
+
+
+def audited_statements(extra_queries=None):
+    """
+    Returns (name, statement) of the warehouse statements to audit: the
+    staging, insert and merge steps and the analytic queries.
+
+    :param extra_queries: (name, query) pairs replacing 'analytic_queries' (optional)
+    """
+    queries = [("staging/" + name, query) for name, query, _ in staging_key_steps] + \
+              [("insert/" + name, query) for name, query, _ in insert_table_steps] + \
+              [("merge/" + name, query) for name, query, _ in merge_table_steps] + \
+              [("analytic/" + name, query) for name, query in (extra_queries or analytic_queries)]
+    return [statement for name, query in queries for statement in split_statements(name, query)]
+
+
+def parse_plan(lines, seq_scan_rows):
+    """
+    Extracts the plan nodes and the findings from EXPLAIN output.
+
+    :param lines: Lines of EXPLAIN output
+    :param seq_scan_rows: Sequential scans estimated to return at least
+                          this many rows are flagged
+    :return: (node names, findings), findings being 'kind: node' strings
+    """
+    nodes, findings = [], []
+    for line in lines:
+        match = PLAN_NODE.match(line)
+        if not match:
+            continue
+        node, rows = match.group("node").strip(), int(match.group("rows"))
+        nodes.append(node)
+
+        if BROADCAST.search(line):
+            findings.append("broadcast: " + node)
+        elif REDISTRIBUTION.search(line):
+            findings.append("redistribution: " + node)
+        if node.startswith("Nested Loop"):
+            findings.append("nested loop: " + node)
+        if node.startswith("Seq Scan") and rows >= seq_scan_rows:
+            findings.append("large seq scan: " + node)
+    return nodes, findings
+
+
+def audit(cur, statements, seq_scan_rows=100000, local=False):
+    """
+    Runs EXPLAIN on each statement; nothing is executed.
+
+    :param cur: cursor object for redshift
+    :param statements: (name, statement) pairs
+    :param seq_scan_rows: Row estimate above which sequential scans are flagged
+    :param local: translate the statements for a Postgres stand-in
+    :return: Dict of statement name to {'nodes': [...], 'findings': [...]}
+    """
+    results = {}
+    for name, statement in statements:
+        cur.execute("EXPLAIN " + (to_postgres(statement) if local else statement))
+        nodes, findings = parse_plan([row[0] for row in cur.fetchall()], seq_scan_rows)
+        results[name] = {"nodes": nodes, "findings": findings}
+    return results
+
+
+def compare(results, baseline):
+    """
+    Prints the findings that are new or resolved since the baseline and
+    the statements whose plan shape changed.
+
+    :param results: Result of 'audit'
+    :param baseline: Audit results loaded from the baseline file
+    :return: Whether there are new findings
+    """
+    regressed = False
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print('{}: no baseline'.format(name))
+            continue
+        for finding in sorted(set(result["findings"]) - set(base["findings"])):
+            print('{}: NEW {}'.format(name, finding))
+            regressed = True
+        for finding in sorted(set(base["findings"]) - set(result["findings"])):
+            print('{}: resolved {}'.format(name, finding))
+        if result["nodes"] != base["nodes"]:
+            print('{}: plan changed from {} to {}'.format(name, " > ".join(base["nodes"]), " > ".join(result["nodes"])))
+    return regressed
+
+
+def read_queries(path):
+    """
+    Reads analytic queries from a SQL file. Statements are separated by
+    ';' and named by a '-- name' comment on their first line.
+
+    :param path: Path of the SQL file
+    :return: (name, query) pairs
+    """
+    with open(path) as f:
+        statements = [statement.strip() for statement in f.read().split(";") if statement.strip()]
+    queries = []
+    for i, statement in enumerate(statements, 1):
+        first = statement.splitlines()[0]
+        name = first[2:].strip() if first.startswith("--") else "query_{}".format(i)
+        queries.append((name, statement))
+    return queries
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Audit the query plans of the warehouse SQL.")
+    parser.add_argument("--queries", metavar="FILE", help="SQL file of analytic queries to audit instead of the built-in ones")
+    parser.add_argument("--seq-scan-rows", type=int, default=100000,
+                        help="flag sequential scans estimated to return at least this many rows")
+    parser.add_argument("--baseline", default="plan_baseline.json", help="audit results to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--local", action="store_true",
+                        help="audit against a local Postgres given in dwh.cfg instead of Redshift")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+    cur = conn.cursor()
+
+    statements = audited_statements(read_queries(args.queries) if args.queries else None)
+    results = audit(cur, statements, args.seq_scan_rows, args.local)
+    conn.close()
+
+    for name, result in results.items():
+        print('{}: {}'.format(name, ", ".join(result["findings"]) or "ok"))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print('baseline saved to {}'.format(args.baseline))
+    else:
+        try:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            return
+        if compare(results, baseline):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
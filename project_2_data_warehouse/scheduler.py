@@ -0,0 +1,124 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+def check_steps(steps):
+    """
+    Checks that every dependency names a step and that the steps have
+    no dependency cycle, raising ValueError otherwise.
+
+    :param steps: List of (name, query, dependencies)
+    :return: Step names in an order where dependencies come first
+    """
+    deps = {name: set(step_deps) for name, _, step_deps in steps}
+    for name, step_deps in deps.items():
+        unknown = step_deps - deps.keys()
+        if unknown:
+            raise ValueError("step '{}' depends on unknown steps {}".format(name, sorted(unknown)))
+
+    order = []
+    while len(order) < len(deps):
+        ready = [name for name in deps if name not in order and deps[name] <= set(order)]
+        if not ready:
+            raise ValueError("dependency cycle between steps {}".format(sorted(deps.keys() - set(order))))
+        order += ready
+    return order
+
+
+def run_step(pool, query, started):
+    """
+    Runs a statement in its own transaction on a pooled connection.
+
+    :param pool: psycopg2 connection pool
+    :param query: SQL statement
+    :param started: perf_counter() value the run started at
+    :return: (start, end) of the statement in seconds since the run started
+    """
+    conn = pool.getconn()
+    try:
+        start = time.perf_counter() - started
+        with conn.cursor() as cur:
+            cur.execute(query)
+        conn.commit()
+        return start, time.perf_counter() - started
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn)
+
+
+def run_steps(steps, pool, workers=4):
+    """
+    Runs SQL statements in dependency order. A statement starts as soon
+    as all the statements it depends on have committed, and statements
+    that do not depend on each other run concurrently, each on its own
+    connection from 'pool'.
+
+    :param steps: List of (name, query, dependencies), dependencies being
+                  the names of the steps that must finish first
+    :param pool: psycopg2 connection pool with at least 'workers' connections
+    :param workers: Maximum number of statements running at once
+    :return: Dict of step name to (start, end) in seconds since the run started
+    """
+    order = check_steps(steps)
+    queries = {name: query for name, query, _ in steps}
+    deps = {name: set(step_deps) for name, _, step_deps in steps}
+
+    timings = {}
+    running = {}
+    started = time.perf_counter()
+    with ThreadPoolExecutor(workers) as executor:
+        while len(timings) < len(order):
+            for name in order:
+                if name not in timings and name not in running.values() and deps[name] <= timings.keys():
+                    running[executor.submit(run_step, pool, queries[name], started)] = name
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                timings[running.pop(future)] = future.result()
+
+    return timings
+
+
+def critical_path(steps, timings):
+    """
+    Returns the chain of dependent steps with the largest total duration,
+    the chain that bounds the run time however many statements run
+    concurrently.
+
+    :param steps: List of (name, query, dependencies)
+    :param timings: Result of 'run_steps'
+    :return: (step names in run order, total seconds)
+    """
+    deps = {name: step_deps for name, _, step_deps in steps}
+    finish, previous = {}, {}
+    for name in check_steps(steps):
+        before = max(deps[name], key=lambda dep: finish[dep], default=None)
+        start, end = timings[name]
+        finish[name] = end - start + (finish[before] if before else 0.0)
+        previous[name] = before
+
+    name = max(finish, key=finish.get)
+    total = finish[name]
+    path = []
+    while name:
+        path.insert(0, name)
+        name = previous[name]
+    return path, total
+
+
+def print_report(steps, timings):
+    """
+    Prints the start time and duration of each step and the critical path.
+
+    :param steps: List of (name, query, dependencies)
+    :param timings: Result of 'run_steps'
+    """
+    for name, _, _ in steps:
+        start, end = timings[name]
+        print('{}: started at {:.2f}s, took {:.2f}s'.format(name, start, end - start))
+
+    path, total = critical_path(steps, timings)
+    wall = max(end for _, end in timings.values())
+    print('critical path: {} ({:.2f}s of {:.2f}s wall time)'.format(" -> ".join(path), total, wall))
@@ -16,11 +16,14 @@ REGION = "us-west-2"
 
 staging_events_table_drop = "DROP TABLE IF EXISTS staging_events"
 staging_songs_table_drop = "DROP TABLE IF EXISTS staging_songs"
+staging_plays_table_drop = "DROP TABLE IF EXISTS staging_plays"
+staging_song_matches_table_drop = "DROP TABLE IF EXISTS staging_song_matches"
 songplay_table_drop = "DROP TABLE IF EXISTS songplays"
 user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+high_water_table_drop = "DROP TABLE IF EXISTS high_water_marks"
 
 # CREATE TABLES
 
@@ -65,6 +68,32 @@ CREATE TABLE IF NOT EXISTS staging_songs
 );
 """)
 
+# NextSong events and songs keyed on their normalised (title, artist name,
+# rounded duration), both distributed and sorted on the key so the
+# songplay join is co-located and can merge join.
+
+staging_plays_table_create = ("""
+CREATE TABLE IF NOT EXISTS staging_plays
+(
+    match_key  VARCHAR(32)  NOT NULL SORTKEY DISTKEY,
+    ts         TIMESTAMP    NOT NULL,
+    userId     VARCHAR      NOT NULL,
+    level      VARCHAR      NULL,
+    sessionId  VARCHAR      NOT NULL,
+    location   VARCHAR      NULL,
+    userAgent  VARCHAR      NULL
+);
+""")
+
+staging_song_matches_table_create = ("""
+CREATE TABLE IF NOT EXISTS staging_song_matches
+(
+    match_key  VARCHAR(32)  NOT NULL SORTKEY DISTKEY,
+    song_id    VARCHAR      NOT NULL,
+    artist_id  VARCHAR      NOT NULL
+);
+""")
+
 songplay_table_create = ("""
 CREATE TABLE songplays
 (
@@ -126,10 +155,21 @@ CREATE TABLE IF NOT EXISTS time
 ) diststyle all;
 """)
 
+high_water_table_create = ("""
+CREATE TABLE IF NOT EXISTS high_water_marks
+(
+    source     VARCHAR(32)  NOT NULL,
+    high_water VARCHAR(10)  NOT NULL,
+    updated_at TIMESTAMP    NOT NULL
+) diststyle all;
+""")
+
 # STAGING TABLES
 
 staging_events_copy = ("""
-COPY staging_events FROM '{}'
+COPY staging_events (artist, auth, firstName, gender, itemInSession, lastName, length, level, location, 
+                     method, page, registration, sessionId, song, status, ts, userAgent, userId)
+FROM '{}'
 credentials 'aws_iam_role={}'
 TIMEFORMAT as 'epochmillisecs'
 format as json '{}'
@@ -144,6 +184,80 @@ format as json 'auto'
 region '{}';
 """).format(SONG_DATA, ARN, REGION)
 
+# Incremental loads copy the log data one day at a time,
+# e.g. s3://udacity-dend/log_data/2018/11/2018-11-05
+staging_events_day_copy = ("""
+COPY staging_events (artist, auth, firstName, gender, itemInSession, lastName, length, level, location, 
+                     method, page, registration, sessionId, song, status, ts, userAgent, userId)
+FROM '{}/{{}}'
+credentials 'aws_iam_role={}'
+TIMEFORMAT as 'epochmillisecs'
+format as json '{}'
+STATUPDATE ON
+region '{}';
+""").format(LOG_DATA, ARN, LOG_JSONPATH, REGION)
+
+# Loads from a local directory into a Postgres stand-in (see staging.py)
+staging_local_copy = "COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+
+staging_plays_insert = ("""
+INSERT INTO staging_plays (match_key, 
+                           ts, 
+                           userId, 
+                           level, 
+                           sessionId, 
+                           location, 
+                           userAgent)
+SELECT  MD5(LOWER(TRIM(song)) || '|' || LOWER(TRIM(artist)) || '|' || 
+            CAST(CAST(ROUND(CAST(length AS FLOAT)) AS INTEGER) AS VARCHAR)) AS match_key,
+        ts,
+        userId,
+        level,
+        sessionId,
+        location,
+        userAgent
+FROM staging_events
+WHERE page = 'NextSong'
+AND song IS NOT NULL
+AND artist IS NOT NULL
+AND length IS NOT NULL
+AND userId IS NOT NULL
+ORDER BY match_key;
+""")
+
+# one song per key, so each play matches at most once
+staging_song_matches_insert = ("""
+INSERT INTO staging_song_matches (match_key, 
+                                  song_id, 
+                                  artist_id)
+SELECT  match_key, song_id, artist_id
+FROM (
+    SELECT  match_key,
+            song_id,
+            artist_id,
+            ROW_NUMBER() OVER (PARTITION BY match_key ORDER BY song_id) AS first
+    FROM (
+        SELECT  MD5(LOWER(TRIM(title)) || '|' || LOWER(TRIM(artist_name)) || '|' || 
+                    CAST(CAST(ROUND(duration) AS INTEGER) AS VARCHAR)) AS match_key,
+                song_id,
+                artist_id
+        FROM staging_songs
+        WHERE title IS NOT NULL
+        AND artist_name IS NOT NULL
+        AND duration IS NOT NULL
+    ) AS keyed
+) AS ranked
+WHERE first = 1
+ORDER BY match_key;
+""")
+
+staging_events_truncate = "TRUNCATE staging_events;"
+staging_songs_truncate = "TRUNCATE staging_songs;"
+staging_plays_truncate = "TRUNCATE staging_plays;"
+staging_song_matches_truncate = "TRUNCATE staging_song_matches;"
+
+# FINAL TABLES
+
 songplay_table_insert = ("""
 INSERT INTO songplays (
     start_time,
@@ -155,17 +269,16 @@ INSERT INTO songplays (
     location,
     user_agent)
 SELECT 
-    se.ts                 AS start_time,
-    se.userId             AS user_id,
-    se.level              AS level,
-    ss.song_id            AS song_id,
-    ss.artist_id          AS artist_id,
-    se.sessionId          AS session_id,
-    se.location           AS location,
-    se.userAgent          AS user_agent
-FROM staging_events as se
-JOIN staging_songs as ss ON (se.artist = ss.artist_name)
-WHERE se.page = 'NextSong';
+    sp.ts                 AS start_time,
+    sp.userId             AS user_id,
+    sp.level              AS level,
+    sm.song_id            AS song_id,
+    sm.artist_id          AS artist_id,
+    sp.sessionId          AS session_id,
+    sp.location           AS location,
+    sp.userAgent          AS user_agent
+FROM staging_plays as sp
+JOIN staging_song_matches as sm ON (sp.match_key = sm.match_key);
 """)
 
 user_table_insert = ("""
@@ -180,7 +293,7 @@ SELECT  DISTINCT(userId)    AS user_id,
         gender,
         level
 FROM staging_events
-WHERE user_id IS NOT NULL
+WHERE userId IS NOT NULL
 AND page  =  'NextSong';
 """)
 
@@ -214,6 +327,8 @@ FROM staging_songs
 WHERE artist_id IS NOT NULL;
 """)
 
+# Only timestamps of this load's songplays that are not in time yet,
+# inserted in sort key order
 time_table_insert = ("""
 INSERT INTO time (start_time, 
                   hour, 
@@ -222,19 +337,187 @@ INSERT INTO time (start_time,
                   month, 
                   year, 
                   weekday)
-SELECT  DISTINCT(start_time)                AS start_time,
-        EXTRACT(hour FROM start_time)       AS hour,
-        EXTRACT(day FROM start_time)        AS day,
-        EXTRACT(week FROM start_time)       AS week,
-        EXTRACT(month FROM start_time)      AS month,
-        EXTRACT(year FROM start_time)       AS year,
-        EXTRACT(dayofweek FROM start_time)  AS weekday
-FROM songplays;
+SELECT  new.start_time                          AS start_time,
+        EXTRACT(hour FROM new.start_time)       AS hour,
+        EXTRACT(day FROM new.start_time)        AS day,
+        EXTRACT(week FROM new.start_time)       AS week,
+        EXTRACT(month FROM new.start_time)      AS month,
+        EXTRACT(year FROM new.start_time)       AS year,
+        EXTRACT(dayofweek FROM new.start_time)  AS weekday
+FROM (
+    SELECT  DISTINCT sp.ts AS start_time
+    FROM staging_plays as sp
+    JOIN staging_song_matches as sm ON (sp.match_key = sm.match_key)
+) AS new
+LEFT JOIN time t ON (new.start_time = t.start_time)
+WHERE t.start_time IS NULL
+ORDER BY new.start_time;
+""")
+
+# MERGE STAGED RECORDS
+# Incremental loads replace the rows that share a key with the staged
+# rows (delete-insert), so reloading a day does not duplicate anything.
+
+songplay_table_merge = ("""
+DELETE FROM songplays
+USING staging_events se
+WHERE songplays.start_time = se.ts
+AND songplays.user_id = se.userId
+AND se.page = 'NextSong';
+""") + songplay_table_insert
+
+user_table_merge = ("""
+DELETE FROM users
+USING staging_events se
+WHERE users.user_id = se.userId
+AND se.page = 'NextSong';
+
+INSERT INTO users (user_id, 
+                   first_name, 
+                   last_name, 
+                   gender, 
+                   level)
+SELECT  user_id, first_name, last_name, gender, level
+FROM (
+    SELECT  userId      AS user_id,
+            firstName   AS first_name,
+            lastName    AS last_name,
+            gender,
+            level,
+            ROW_NUMBER() OVER (PARTITION BY userId ORDER BY ts DESC) AS latest
+    FROM staging_events
+    WHERE userId IS NOT NULL
+    AND page  =  'NextSong'
+) AS se
+WHERE latest = 1;
+""")
+
+song_table_merge = ("""
+DELETE FROM songs
+USING staging_songs ss
+WHERE songs.song_id = ss.song_id;
+
+INSERT INTO songs (song_id, 
+                   title, 
+                   artist_id, 
+                   year, 
+                   duration)
+SELECT  song_id, title, artist_id, year, duration
+FROM (
+    SELECT  song_id,
+            title,
+            artist_id,
+            year,
+            duration,
+            ROW_NUMBER() OVER (PARTITION BY song_id ORDER BY year DESC) AS latest
+    FROM staging_songs
+    WHERE song_id IS NOT NULL
+) AS ss
+WHERE latest = 1;
+""")
+
+artist_table_merge = ("""
+DELETE FROM artists
+USING staging_songs ss
+WHERE artists.artist_id = ss.artist_id;
+
+INSERT INTO artists (artist_id, 
+                     name, 
+                     location, 
+                     latitude, 
+                     longitude)
+SELECT  artist_id, name, location, latitude, longitude
+FROM (
+    SELECT  artist_id,
+            artist_name         AS name,
+            artist_location     AS location,
+            artist_latitude     AS latitude,
+            artist_longitude    AS longitude,
+            ROW_NUMBER() OVER (PARTITION BY artist_id ORDER BY artist_latitude) AS latest
+    FROM staging_songs
+    WHERE artist_id IS NOT NULL
+) AS ss
+WHERE latest = 1;
+""")
+
+# time rows only depend on the timestamp, so existing rows are kept as they are
+time_table_merge = time_table_insert
+
+# HIGH WATER MARKS
+# The last log day loaded, incremental loads only copy later days.
+
+high_water_select = "SELECT high_water FROM high_water_marks WHERE source = 'log_data';"
+
+high_water_update = ("""
+DELETE FROM high_water_marks WHERE source = 'log_data';
+
+INSERT INTO high_water_marks (source, high_water, updated_at)
+SELECT 'log_data', TO_CHAR(MAX(ts), 'YYYY-MM-DD'), GETDATE()
+FROM staging_events
+HAVING MAX(ts) IS NOT NULL;
+""")
+
+# ANALYTIC QUERIES
+# Typical dashboard queries, audited by plan_audit.py with the loads.
+
+plays_per_hour_select = ("""
+SELECT  t.hour, COUNT(*) AS plays
+FROM songplays sp
+JOIN time t ON (sp.start_time = t.start_time)
+GROUP BY t.hour
+ORDER BY t.hour;
+""")
+
+top_songs_select = ("""
+SELECT  s.title, a.name, COUNT(*) AS plays
+FROM songplays sp
+JOIN songs s ON (sp.song_id = s.song_id)
+JOIN artists a ON (sp.artist_id = a.artist_id)
+GROUP BY s.title, a.name
+ORDER BY plays DESC
+LIMIT 10;
+""")
+
+plays_by_level_select = ("""
+SELECT  u.level, COUNT(*) AS plays
+FROM songplays sp
+JOIN users u ON (sp.user_id = u.user_id)
+GROUP BY u.level;
 """)
 
 # QUERY LISTS
 
-create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
+create_table_queries = [staging_events_table_create, staging_songs_table_create, staging_plays_table_create, staging_song_matches_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, high_water_table_create]
+drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, staging_plays_table_drop, staging_song_matches_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, high_water_table_drop]
 copy_table_queries = [staging_events_copy, staging_songs_copy]
+staging_truncate_queries = [staging_events_truncate, staging_songs_truncate, staging_plays_truncate, staging_song_matches_truncate]
 insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert, time_table_insert]
+
+analytic_queries = [("plays_per_hour", plays_per_hour_select), ("top_songs", top_songs_select), ("plays_by_level", plays_by_level_select)]
+
+# QUERY DEPENDENCIES
+# (name, query, names of the steps that must finish first)
+
+copy_table_steps = [("staging_events", staging_events_copy, []),
+                    ("staging_songs", staging_songs_copy, []),
+                    ("staging_plays", staging_plays_insert, ["staging_events"]),
+                    ("staging_song_matches", staging_song_matches_insert, ["staging_songs"])]
+# keying the staged rows, for staging tables loaded by other means
+staging_key_steps = [("staging_plays", staging_plays_insert, []),
+                     ("staging_song_matches", staging_song_matches_insert, [])]
+insert_table_steps = [("songplays", songplay_table_insert, []),
+                      ("users", user_table_insert, []),
+                      ("songs", song_table_insert, []),
+                      ("artists", artist_table_insert, []),
+                      ("time", time_table_insert, []),
+                      ("high_water", high_water_update, [])]
+merge_table_steps = [("songplays", songplay_table_merge, []),
+                     ("users", user_table_merge, []),
+                     ("songs", song_table_merge, []),
+                     ("artists", artist_table_merge, []),
+                     ("time", time_table_merge, []),
+                     ("high_water", high_water_update, ["songplays", "users", "songs", "artists", "time"]),
+                     ("truncate_staging_events", staging_events_truncate, ["high_water"]),
+                     ("truncate_staging_songs", staging_songs_truncate, ["high_water"]),
+                     ("truncate_staging_plays", staging_plays_truncate, ["high_water"]),
+                     ("truncate_staging_song_matches", staging_song_matches_truncate, ["high_water"])]
@@ -0,0 +1,150 @@
+import io
+import os
+import re
+import csv
+import json
+import glob
+from datetime import date, datetime, timedelta
+from sql_queries import (LOG_DATA, staging_songs_copy, staging_events_day_copy, staging_local_copy,
+                         staging_plays_insert, staging_song_matches_insert)
+
+LOG_FILE_PATTERN = re.compile(r"(\d{4})-(\d{2})-(\d{2})-events\.json$")
+
+EVENT_COLUMNS = ["artist", "auth", "firstName", "gender", "itemInSession", "lastName", "length",
+                 "level", "location", "method", "page", "registration", "sessionId", "song",
+                 "status", "ts", "userAgent", "userId"]
+SONG_COLUMNS = ["num_songs", "artist_id", "artist_latitude", "artist_longitude", "artist_location",
+                "artist_name", "song_id", "title", "duration", "year"]
+
+
+def log_file_day(path):
+    """
+    Returns the day of a log file from its name (YYYY-MM-DD-events.json),
+    or None for other files.
+
+    :param path: Path or S3 key of the file
+    """
+    match = LOG_FILE_PATTERN.search(path)
+    return date(*map(int, match.groups())) if match else None
+
+
+def list_local_log_days(log_dir):
+    """
+    Lists the log files under a local directory by day.
+
+    :param log_dir: Local log_data directory
+    :return: Dict of day to the paths of that day's files
+    """
+    days = {}
+    for path in sorted(glob.glob(os.path.join(log_dir, "**", "*.json"), recursive=True)):
+        day = log_file_day(path)
+        if day:
+            days.setdefault(day, []).append(path)
+    return days
+
+
+def list_s3_log_days(log_data=LOG_DATA):
+    """
+    Lists the log files under the S3 log data prefix by day.
+
+    :param log_data: S3 URL of the log data, e.g. s3://udacity-dend/log_data
+    :return: Dict of day to the keys of that day's files
+    """
+    import boto3
+
+    bucket, _, prefix = log_data[len("s3://"):].partition("/")
+    days = {}
+    for page in boto3.client("s3").get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get("Contents", []):
+            day = log_file_day(item["Key"])
+            if day:
+                days.setdefault(day, []).append(item["Key"])
+    return days
+
+
+def new_log_days(days, high_water=None, until=None):
+    """
+    Returns the days after the high-water mark, up to and including
+    'until', oldest first.
+
+    :param days: Dict of day to files, as listed by 'list_*_log_days'
+    :param high_water: Last day already loaded, as 'YYYY-MM-DD' (optional)
+    :param until: Last day to load (optional)
+    """
+    after = datetime.strptime(high_water, "%Y-%m-%d").date() if high_water else date.min
+    return sorted(day for day in days if after < day and (until is None or day <= until))
+
+
+def s3_copy_steps(days):
+    """
+    Returns scheduler steps copying the song data and the log data of
+    'days' into the staging tables, one COPY per day, and keying them.
+
+    :param days: Days of log data to copy
+    """
+    day_steps = [("staging_events_{}".format(day), staging_events_day_copy.format("{:%Y/%m/%Y-%m-%d}".format(day)), [])
+                 for day in days]
+    return [("staging_songs", staging_songs_copy, [])] + day_steps + \
+           [("staging_plays", staging_plays_insert, [name for name, _, _ in day_steps]),
+            ("staging_song_matches", staging_song_matches_insert, ["staging_songs"])]
+
+
+def read_json_records(path):
+    """
+    Reads a JSON file holding either one object or one object per line.
+
+    :param path: Path of the file
+    """
+    with open(path) as f:
+        text = f.read()
+    try:
+        return [json.loads(text)]
+    except ValueError:
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def copy_records(cur, table, columns, records):
+    """
+    Streams records into a Postgres table with COPY.
+
+    :param cur: cursor object for postgres
+    :param table: name of the table
+    :param columns: columns to load, also the record keys
+    :param records: iterable of dicts
+    """
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for record in records:
+        # NULL is written as \N, so COPY tells it from an empty string
+        writer.writerow(["\\N" if record.get(column) is None else record[column] for column in columns])
+    buf.seek(0)
+    cur.copy_expert(staging_local_copy.format(table, ", ".join(columns)), buf)
+
+
+def copy_local_events(cur, paths):
+    """
+    Loads local log files into staging_events as the Redshift COPY
+    would, with 'ts' converted from epoch milliseconds to a timestamp.
+
+    :param cur: cursor object for postgres
+    :param paths: log files to load
+    """
+    def events():
+        for path in paths:
+            for record in read_json_records(path):
+                record["ts"] = str(datetime(1970, 1, 1) + timedelta(milliseconds=record["ts"]))
+                yield record
+
+    copy_records(cur, "staging_events", EVENT_COLUMNS, events())
+
+
+def copy_local_songs(cur, song_dir):
+    """
+    Loads the local song files under 'song_dir' into staging_songs.
+
+    :param cur: cursor object for postgres
+    :param song_dir: Local song_data directory
+    """
+    paths = sorted(glob.glob(os.path.join(song_dir, "**", "*.json"), recursive=True))
+    copy_records(cur, "staging_songs", SONG_COLUMNS,
+                 (record for path in paths for record in read_json_records(path)))
@@ -0,0 +1,215 @@
+import math
+import uuid
+from datetime import datetime, timezone
+from itertools import chain
+from pyspark.sql.functions import col, concat_ws, create_map, element_at, hash, \
+                                  input_file_name, lit, pmod, regexp_extract
+from pyspark.sql.types import StructType, StructField, StringType, LongType
+from schemas import SCHEMAS, read_json
+
+# Roughly how many bytes of JSON compact into one byte of Parquet, for
+# sizing the compacted files
+JSON_BYTES_PER_PARQUET_BYTE = 4
+
+# Number of leading directories under a source that make up its
+# partitions: song_data/A/... and log_data/2018/11/...
+PARTITION_DEPTH = {
+    'song_data': 1,
+    'log_data': 2
+}
+
+MANIFEST_SCHEMA = StructType([
+    StructField('path', StringType()),
+    StructField('size', LongType()),
+    StructField('source_partition', StringType()),
+    StructField('batch', StringType())
+])
+
+PROCESSED_SCHEMA = StructType([
+    StructField('batch', StringType())
+])
+
+
+def hadoop_path(spark, path):
+    """
+    Returns the Hadoop FileSystem and Path of a location, so the same
+    listing works on S3 and on the local filesystem.
+
+    :param spark: Spark instance
+    :param path: S3 or local location
+    """
+    hpath = spark._jvm.org.apache.hadoop.fs.Path(path)
+    return hpath.getFileSystem(spark._jsc.hadoopConfiguration()), hpath
+
+
+def list_inputs(spark, input_data, source, glob):
+    """
+    Lists the raw JSON files of a source by partition.
+
+    :param spark: Spark instance
+    :param input_data: input S3 location
+    :param source: Source name, a key of PARTITION_DEPTH
+    :param glob: files to list, relative to 'input_data'
+    :return: Dict of partition name to list of (path, size)
+    """
+    input_data = input_data.rstrip("/")
+    fs, pattern = hadoop_path(spark, f"{input_data}/{glob}")
+    root = fs.makeQualified(hadoop_path(spark, f"{input_data}/{source}")[1]).toString().rstrip("/")
+
+    partitions = {}
+    for status in fs.globStatus(pattern) or []:
+        if not status.isFile():
+            continue
+        path = status.getPath().toString()
+        parts = path[len(root) + 1:].split("/")
+        partition = "-".join(parts[:PARTITION_DEPTH[source]])
+        partitions.setdefault(partition, []).append((path, status.getLen()))
+    return partitions
+
+
+def read_manifest(spark, bronze_data, source):
+    """
+    Returns the manifest rows of the inputs already compacted.
+
+    :param spark: Spark instance
+    :param bronze_data: bronze layer location
+    :param source: Source name
+    """
+    fs, path = hadoop_path(spark, f"{bronze_data}/_manifest/{source}")
+    if not fs.exists(path):
+        return []
+    return spark.read.schema(MANIFEST_SCHEMA).parquet(path.toString()).collect()
+
+
+def remove_orphan_batches(spark, bronze_data, source, batches):
+    """
+    Deletes compacted batches missing from the manifest, left by a run
+    that failed before recording them, so their inputs are compacted
+    again without duplicating rows.
+
+    :param spark: Spark instance
+    :param bronze_data: bronze layer location
+    :param source: Source name
+    :param batches: Batch names recorded in the manifest
+    """
+    fs, pattern = hadoop_path(spark, f"{bronze_data}/{source}/batch=*")
+    for status in fs.globStatus(pattern) or []:
+        if status.getPath().getName()[len("batch="):] not in batches:
+            fs.delete(status.getPath(), True)
+
+
+def compact_source(spark, input_data, bronze_data, source, glob, target_bytes):
+    """
+    Compacts the raw JSON files of a source that are not yet in the
+    manifest into Parquet files of about 'target_bytes' each, written as a
+    new batch partitioned by source partition, then records them in the
+    manifest. All new files are compacted by a single job: rows are spread
+    over as many tasks as the partitions need files, each task writing the
+    files of one partition. Raw inputs are assumed immutable once written.
+
+    :param spark: Spark instance
+    :param input_data: input S3 location
+    :param bronze_data: bronze layer location
+    :param source: Source name, a key of PARTITION_DEPTH
+    :param glob: files to compact, relative to 'input_data'
+    :param target_bytes: Target size of a compacted file
+    :return: Number of input files compacted
+    """
+    manifest = read_manifest(spark, bronze_data, source)
+    remove_orphan_batches(spark, bronze_data, source, {row.batch for row in manifest})
+    compacted = {row.path for row in manifest}
+
+    # sortable by time, and unique even for compactions started in the same second
+    batch = "{}-{}".format(datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S"), uuid.uuid4().hex[:8])
+    rows = []
+    n_files = {}
+    for partition, files in sorted(list_inputs(spark, input_data, source, glob).items()):
+        new = [(path, size) for path, size in files if path not in compacted]
+        if new:
+            input_bytes = sum(size for _, size in new)
+            n_files[partition] = max(1, math.ceil(input_bytes / JSON_BYTES_PER_PARQUET_BYTE / target_bytes))
+            rows += [(path, size, partition, batch) for path, size in new]
+
+    if rows:
+        # the partition is the leading directories under the source, as in list_inputs
+        pattern = "/{}/{}".format(source, "".join(["([^/]+)/"] * PARTITION_DEPTH[source]))
+        source_partition = concat_ws("-", *[regexp_extract(input_file_name(), pattern, group)
+                                            for group in range(1, PARTITION_DEPTH[source] + 1)])
+        # spread the rows of a partition over its files
+        files_of = element_at(create_map(*[lit(value) for value in chain(*n_files.items())]),
+                              col('source_partition'))
+        fields = SCHEMAS[source].fieldNames()
+
+        read_json(spark, source, [row[0] for row in rows]) \
+            .withColumn('source_partition', source_partition) \
+            .withColumn('bucket', pmod(hash(*fields), files_of)) \
+            .repartition(sum(n_files.values()), 'source_partition', 'bucket') \
+            .drop('bucket') \
+            .write \
+            .partitionBy('source_partition') \
+            .parquet(f"{bronze_data}/{source}/batch={batch}")
+
+        spark.createDataFrame(rows, MANIFEST_SCHEMA) \
+             .coalesce(1) \
+             .write \
+             .mode('append') \
+             .parquet(f"{bronze_data}/_manifest/{source}")
+    print('{}: compacted {} new files into the bronze layer'.format(source, len(rows)))
+    return len(rows)
+
+
+def pending_batches(spark, bronze_data, source):
+    """
+    Returns the compacted batches of a source not yet marked processed
+    into the output tables.
+
+    :param spark: Spark instance
+    :param bronze_data: bronze layer location
+    :param source: Source name
+    :return: Dict of batch name to the source partitions it holds
+    """
+    fs, path = hadoop_path(spark, f"{bronze_data}/_processed/{source}")
+    processed = set()
+    if fs.exists(path):
+        processed = {row.batch for row in spark.read.schema(PROCESSED_SCHEMA).parquet(path.toString()).collect()}
+
+    batches = {}
+    for row in read_manifest(spark, bronze_data, source):
+        if row.batch not in processed:
+            batches.setdefault(row.batch, set()).add(row.source_partition)
+    return batches
+
+
+def mark_processed(spark, bronze_data, source, batches):
+    """
+    Records batches of a source as processed into the output tables.
+
+    :param spark: Spark instance
+    :param bronze_data: bronze layer location
+    :param source: Source name
+    :param batches: Batch names
+    """
+    if batches:
+        spark.createDataFrame([(batch,) for batch in sorted(batches)], PROCESSED_SCHEMA) \
+             .coalesce(1) \
+             .write \
+             .mode('append') \
+             .parquet(f"{bronze_data}/_processed/{source}")
+
+
+def read_bronze(spark, bronze_data, source, partitions=None, batches=None):
+    """
+    Reads the compacted Parquet of a source with its registered columns.
+
+    :param spark: Spark instance
+    :param bronze_data: bronze layer location
+    :param source: Source name, a key of SCHEMAS
+    :param partitions: only read these source partitions (optional)
+    :param batches: only read these batches (optional)
+    """
+    df = spark.read.parquet(f"{bronze_data}/{source}")
+    if partitions is not None:
+        df = df.where(col('source_partition').isin(sorted(partitions)))
+    if batches is not None:
+        df = df.where(col('batch').isin(sorted(batches)))
+    return df.select(*SCHEMAS[source].fieldNames())
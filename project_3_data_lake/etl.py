@@ -1,90 +1,224 @@
+import argparse
 import configparser
-from datetime import datetime
 import os
-from pyspark.sql import SparkSession
-from pyspark.sql.functions import udf, col, year, \
-                                  month, dayofmonth, hour, 
-                                  weekofyear, date_format, \
-                                  monotonically_increasing_id
+from pyspark import StorageLevel
+from pyspark.sql import SparkSession, Window
+from pyspark.sql.functions import col, year, \
+                                  month, dayofmonth, hour, \
+                                  weekofyear, broadcast, \
+                                  md5, concat_ws, date_format, \
+                                  row_number, round
+from compaction import compact_source, read_bronze, pending_batches, mark_processed
+from writer import TABLE_PARTITIONS, estimated_size, parse_partitioning, write_table, merge_table, \
+                   file_size_report
+
+# Song files read from S3, a sample of the full dataset
+SONG_DATA_GLOB = "song_data/A/A/A/*.json"
+LOG_DATA_GLOB = "log_data/*/*/*.json"
+
+# Target size of a written Parquet file, in the bronze layer and the tables
+TARGET_FILE_BYTES = 128 * 1024 * 1024
+
+# Largest estimated song dimension broadcast to every executor for the
+# songplays join
+BROADCAST_THRESHOLD = 64 * 1024 * 1024
+
+
+def create_spark_session(local=False):
+    """
+    Creates the Spark session, with the S3 connector or, when 'local',
+    running in local mode on all cores. Timestamps are handled in UTC, the
+    time zone the log data is partitioned by.
 
+    :param local: run Spark in local mode against local files
+    """
+    builder = SparkSession.builder.config("spark.sql.session.timeZone", "UTC")
+    if local:
+        builder = builder.master("local[*]")
+    else:
+        builder = builder.config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0")
+    return builder.getOrCreate()
+
+
+def compact_inputs(spark,
+                   input_data,
+                   bronze_data,
+                   song_glob=SONG_DATA_GLOB,
+                   target_bytes=TARGET_FILE_BYTES):
+    """
+    Compacts the new raw song and log JSON into the Parquet bronze layer
+    the later stages read.
 
-def create_spark_session():
-    spark = SparkSession \
-        .builder \
-        .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0") \
-        .getOrCreate()
-    return spark
+    :param spark: Spark instance
+    :param input_data: input S3 location
+    :param bronze_data: bronze layer location
+    :param song_glob: song files to compact, relative to 'input_data'
+    :param target_bytes: Target size of a compacted file
+    """
+    compact_source(spark, input_data, bronze_data, 'song_data', song_glob, target_bytes)
+    compact_source(spark, input_data, bronze_data, 'log_data', LOG_DATA_GLOB, target_bytes)
 
 
-def process_song_data(spark,
-                      input_data,
-                      output_data):
+def load_song_data(spark,
+                   bronze_data):
     """
-    Processes song data and outputs parquet patitioned data to S3.
+    Reads the song data once per run and keeps it cached for the songs,
+    artists and songplays tables.
 
     :param spark: Spark instance
-    :param input_data: input S3 location
+    :param bronze_data: bronze layer location
+    """
+    return read_bronze(spark, bronze_data, 'song_data').persist(StorageLevel.MEMORY_AND_DISK)
+
+
+def join_song_dimension(plays, song_df, broadcast_threshold=BROADCAST_THRESHOLD):
+    """
+    Matches song plays to songs on title, artist name and duration rounded
+    to whole seconds, half away from zero as in the Postgres and Redshift
+    loaders, so all three resolve the same plays. The song dimension is
+    broadcast when its estimated size is within 'broadcast_threshold', so
+    the plays are joined where they are instead of being shuffled. Prints the shuffle bytes this saves against a
+    shuffle join of the plays with the whole song data on title.
+
+    :param plays: Log events of song plays
+    :param song_df: Song data from 'load_song_data'
+    :param broadcast_threshold: Largest song dimension in bytes to broadcast
+    """
+    songs = song_df.select('title', 'artist_name', round('duration').alias('rounded_duration'),
+                           'song_id', 'artist_id') \
+        .drop_duplicates(subset=['title', 'artist_name', 'rounded_duration'])
+
+    plays_bytes = estimated_size(plays)
+    songs_bytes = estimated_size(songs)
+    shuffle_join_bytes = plays_bytes + estimated_size(song_df)
+
+    if songs_bytes <= broadcast_threshold:
+        songs = broadcast(songs)
+        shuffled = 0
+    else:
+        shuffled = plays_bytes + songs_bytes
+    print('songplays join: song dimension {:.1f} MB, {}; shuffles {:.1f} MB instead of {:.1f} MB ({:.1f} MB saved)'.format(
+        songs_bytes / 2 ** 20, "broadcast" if shuffled == 0 else "over the broadcast threshold",
+        shuffled / 2 ** 20, shuffle_join_bytes / 2 ** 20, (shuffle_join_bytes - shuffled) / 2 ** 20))
+
+    return plays.join(songs, (plays.song == songs.title) &
+                             (plays.artist == songs.artist_name) &
+                             (round(plays.length) == songs.rounded_duration))
+
+
+def save_table(spark,
+               table,
+               name,
+               output_data,
+               partitioning=TABLE_PARTITIONS,
+               target_bytes=TARGET_FILE_BYTES,
+               merge_key=None):
+    """
+    Writes an output table in files of about 'target_bytes' and reports
+    the files written.
+
+    :param spark: Spark instance
+    :param table: Table to write
+    :param name: Table name, a key of 'partitioning'
     :param output_data: output S3 location
+    :param partitioning: Dict of table name to partition columns
+    :param target_bytes: Target size of a written file
+    :param merge_key: merge the rows into the stored table on this key
+                      instead of overwriting it (optional)
     """
-    # get filepath to song data file
-    song_data = f"{input_data}/song_data/A/A/A/*.json"
+    path = os.path.join(output_data, f"{name}.pqt")
+    if merge_key:
+        merge_table(spark, table, path, merge_key, partitioning[name], target_bytes)
+    else:
+        write_table(table, path, partitioning[name], target_bytes)
+    file_size_report(spark, name, path)
+
 
-    # read song data file
-    df = spark.read.json(song_data)
+def process_song_data(spark,
+                      song_df,
+                      output_data,
+                      partitioning=TABLE_PARTITIONS,
+                      target_bytes=TARGET_FILE_BYTES,
+                      incremental=False):
+    """
+    Processes song data and outputs parquet patitioned data to S3.
 
+    :param spark: Spark instance
+    :param song_df: Song data from 'load_song_data', or only the new song
+                    data when 'incremental'
+    :param output_data: output S3 location
+    :param partitioning: Dict of table name to partition columns
+    :param target_bytes: Target size of a written file
+    :param incremental: merge the songs and artists into the stored tables
+    """
     # extract columns to create songs table
-    songs_table = df['song_id',
-                     'title',
-                     'artist_id',
-                     'year',
-                     'duration']
-
-    # write songs table to parquet files partitioned by year and artist
-    songs_table.write \
-               .partitionBy(['year', 'artist_id']) \
-               .parquet(os.path.join(output_data, 'songs.pqt'), 'overwrite')
+    songs_table = song_df['song_id',
+                          'title',
+                          'artist_id',
+                          'year',
+                          'duration']
+
     songs_table = songs_table.drop_duplicates(subset=['song_id'])
 
+    # write songs table to parquet files, by default partitioned by year and artist
+    save_table(spark, songs_table, 'songs', output_data, partitioning, target_bytes,
+               'song_id' if incremental else None)
+
     # extract columns to create artists table
-    artists_table = df['artist_id', 'artist_name',
-                       'artist_location', 'artist_latitude', 'artist_longitude']
+    artists_table = song_df['artist_id', 'artist_name',
+                            'artist_location', 'artist_latitude', 'artist_longitude']
     artists_table = artists_table.drop_duplicates(subset=['artist_id'])
 
     # write artists table to parquet files
-    artists_table.write.parquet(os.path.join(
-        output_data, 'artists.pqt'), 'overwrite')
+    save_table(spark, artists_table, 'artists', output_data, partitioning, target_bytes,
+               'artist_id' if incremental else None)
 
 
 def process_log_data(spark,
-                     input_data,
-                     output_data):
+                     bronze_data,
+                     output_data,
+                     song_df,
+                     broadcast_threshold=BROADCAST_THRESHOLD,
+                     partitioning=TABLE_PARTITIONS,
+                     target_bytes=TARGET_FILE_BYTES,
+                     partitions=None,
+                     incremental=False):
     """
     Processes log data and outputs parquet patitioned data to S3.
 
     :param spark: Spark instance
-    :param input_data: input S3 location
+    :param bronze_data: bronze layer location
     :param output_data: output S3 location
+    :param song_df: Song data from 'load_song_data'
+    :param broadcast_threshold: Largest song dimension in bytes to broadcast
+    :param partitioning: Dict of table name to partition columns
+    :param target_bytes: Target size of a written file
+    :param partitions: only process these year-month log partitions (optional)
+    :param incremental: merge the users into the stored table; the time and
+                        songplays months are overwritten when the session
+                        uses dynamic partition overwrite
     """
-    # get filepath to log data file
-    log_data = f"{input_data}/log_data/*/*/*.json"
-
-    # read log data file
-    df = spark.read.json(log_data)
-
-    # filter by actions for song plays
-    song_plays = df[df.page == 'NextSong']
+    # read compacted log data
+    df = read_bronze(spark, bronze_data, 'log_data', partitions)
 
-    # extract columns for users table
-    users_table = df['userId', 'firstName', 'lastName', 'gender', 'level']
-    users_table = users_table.drop_duplicates(subset=['userId'])
+    # extract columns for users table from the latest song play of each
+    # logged-in user, so the level is the current one
+    latest = Window.partitionBy('userId').orderBy(col('ts').desc())
+    users_table = df.where((df.page == 'NextSong') & (df.userId != '')) \
+        .withColumn('row', row_number().over(latest)) \
+        .where(col('row') == 1)
+    users_table = users_table['userId', 'firstName', 'lastName', 'gender', 'level']
 
     # write users table to parquet files
-    users_table.write \
-               .parquet(os.path.join(output_data, "users.pqt"), 'overwrite')
+    save_table(spark, users_table, 'users', output_data, partitioning, target_bytes,
+               'userId' if incremental else None)
 
-    # create datetime column from timestamp column
-    get_dt = udf(lambda t: datetime.fromtimestamp(t // 1000))
-    df = df.withColumn('datetime', get_dt(df.ts))
+    # create datetime column from the epoch milliseconds in ts
+    df = df.withColumn('datetime', (col('ts') / 1000).cast('timestamp'))
+    if partitions is not None:
+        # only write the months being reprocessed, so an event filed under a
+        # neighbouring month cannot overwrite that month with a partial copy
+        df = df.where(date_format('datetime', 'yyyy-MM').isin(sorted(partitions)))
 
     # extract columns to create time table
     time_table = df.select(
@@ -97,23 +231,21 @@ def process_log_data(spark,
     )
     time_table = time_table.dropDuplicates(['start_time'])
 
-    # write time table to parquet files partitioned by year and month
-    time_table.write \
-              .partitionBy(['year', 'month']) \
-              .parquet(os.path.join(output_data, "time.pqt"), 'overwrite')
+    # write time table to parquet files, by default partitioned by year and month
+    save_table(spark, time_table, 'time', output_data, partitioning, target_bytes)
 
-    # read in song data to use for songplays table
-    song_data = f"{input_data}/song-data/A/A/A/*.json"
-    song_df = spark.read \
-                   .json(song_data)
+    # filter by actions for song plays
+    song_plays = df[df.page == 'NextSong']
 
     # extract columns from joined song and log datasets to create songplays table
-    df = df['datetime', 'userId', 'level', 'song',
-            'artist', 'sessionId', 'location', 'userAgent']
+    song_plays = song_plays['ts', 'datetime', 'userId', 'level', 'song', 'artist',
+                            'length', 'sessionId', 'itemInSession', 'location', 'userAgent']
 
-    log_song_df = df.join(song_df, df.song == song_df.title)
+    log_song_df = join_song_dimension(song_plays, song_df, broadcast_threshold)
 
     songplays_table = log_song_df.select(
+        # derived from the event, so reprocessing a month gives the same IDs
+        md5(concat_ws('|', 'ts', 'userId', 'sessionId', 'itemInSession')).alias('songplay_id'),
         col('datetime').alias('ts'),
         col('userId').alias('user_id'),
         col('level').alias('level'),
@@ -126,32 +258,90 @@ def process_log_data(spark,
         month('datetime').alias('month')
     )
 
-    songplays_table.select(
-        monotonically_increasing_id().alias('songplay_id')).collect()
-
-    # write songplays table to parquet files partitioned by year and month
-    songplays_table.write \
-                   .partitionBy('year', 'month') \
-                   .parquet(os.path.join(output_data, "songplays.pqt"), 'overwrite')
+    # write songplays table to parquet files, by default partitioned by year and month
+    save_table(spark, songplays_table, 'songplays', output_data, partitioning, target_bytes)
 
 
 def main():
-
-    input_data = "s3a://udacity-dend/"
-    output_data = "s3a://INSERT_BUCKET_NAME_HERE/"
-
-    config = configparser.ConfigParser()
-    config.read('dl.cfg')
-
-    os.environ['AWS_ACCESS_KEY_ID'] = config['AWS']['AWS_ACCESS_KEY_ID']
-    os.environ['AWS_SECRET_ACCESS_KEY'] = config['AWS']['AWS_SECRET_ACCESS_KEY']
-
-    print(os.environ['AWS_ACCESS_KEY_ID'])
-
-    spark = create_spark_session()
-
-    process_song_data(spark, input_data, output_data)
-    process_log_data(spark, input_data, output_data)
+    parser = argparse.ArgumentParser(description="Process the Sparkify song and log data into Parquet tables.")
+    parser.add_argument("--local", metavar="DIR",
+                        help="run Spark in local mode on the song_data and log_data in DIR instead of S3")
+    parser.add_argument("--output", metavar="PATH",
+                        help="where the tables are written (default: the S3 bucket, or DIR/output with --local)")
+    parser.add_argument("--bronze", metavar="PATH",
+                        help="where the compacted raw data is kept (default: bronze/ under the output location)")
+    parser.add_argument("--target-file-mb", type=float, default=TARGET_FILE_BYTES / 2 ** 20,
+                        help="target size of a written Parquet file, in the bronze layer and the tables")
+    parser.add_argument("--partition-by", metavar="TABLE=COLUMNS", action="append", default=[],
+                        help="partition a table by these comma-separated columns instead of the default, "
+                             "e.g. songs=year; an empty list leaves the table unpartitioned (repeatable)")
+    parser.add_argument("--broadcast-mb", type=float, default=BROADCAST_THRESHOLD / 2 ** 20,
+                        help="broadcast the song dimension to the songplays join when it is estimated at most this size")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only process newly compacted data: overwrite the time and songplays months it "
+                             "touches and merge new songs, artists and users into the stored tables")
+    args = parser.parse_args()
+
+    try:
+        partitioning = parse_partitioning(args.partition_by)
+    except ValueError as e:
+        parser.error(str(e))
+    target_bytes = int(args.target_file_mb * 2 ** 20)
+    if args.incremental:
+        for name in ('time', 'songplays'):
+            if not {'year', 'month'} <= set(partitioning[name]):
+                parser.error(f"--incremental overwrites whole months, so {name} must be partitioned by year and month")
+
+    if args.local:
+        input_data = args.local
+        output_data = args.output or os.path.join(args.local, "output")
+        # a local tree is read whole, whatever its directory names
+        song_glob = "song_data/*/*/*/*.json"
+    else:
+        input_data = "s3a://udacity-dend/"
+        output_data = args.output or "s3a://INSERT_BUCKET_NAME_HERE/"
+        song_glob = SONG_DATA_GLOB
+
+        config = configparser.ConfigParser()
+        config.read('dl.cfg')
+
+        os.environ['AWS_ACCESS_KEY_ID'] = config['AWS']['AWS_ACCESS_KEY_ID']
+        os.environ['AWS_SECRET_ACCESS_KEY'] = config['AWS']['AWS_SECRET_ACCESS_KEY']
+
+        print(os.environ['AWS_ACCESS_KEY_ID'])
+
+    bronze_data = args.bronze or os.path.join(output_data, "bronze")
+
+    spark = create_spark_session(args.local is not None)
+    if args.incremental:
+        # overwriting a partitioned table only replaces the partitions written
+        spark.conf.set("spark.sql.sources.partitionOverwriteMode", "dynamic")
+
+    compact_inputs(spark, input_data, bronze_data, song_glob, target_bytes)
+    song_batches = pending_batches(spark, bronze_data, 'song_data')
+    log_batches = pending_batches(spark, bronze_data, 'log_data')
+
+    song_df = load_song_data(spark, bronze_data)
+    broadcast_threshold = int(args.broadcast_mb * 2 ** 20)
+    if not args.incremental:
+        process_song_data(spark, song_df, output_data, partitioning, target_bytes)
+        process_log_data(spark, bronze_data, output_data, song_df, broadcast_threshold,
+                         partitioning, target_bytes)
+    elif not song_batches and not log_batches:
+        print('No new data.')
+    else:
+        if song_batches:
+            new_songs = read_bronze(spark, bronze_data, 'song_data', batches=song_batches)
+            process_song_data(spark, new_songs, output_data, partitioning, target_bytes, incremental=True)
+        if log_batches:
+            months = set().union(*log_batches.values())
+            print('Processing log data of {}.'.format(", ".join(sorted(months))))
+            process_log_data(spark, bronze_data, output_data, song_df, broadcast_threshold,
+                             partitioning, target_bytes, months, incremental=True)
+
+    mark_processed(spark, bronze_data, 'song_data', song_batches)
+    mark_processed(spark, bronze_data, 'log_data', log_batches)
+    song_df.unpersist()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,54 @@
+from pyspark.sql.types import StructType, StructField, StringType, \
+                              DoubleType, LongType
+
+# Explicit schemas of the JSON sources, so Spark reads each file once
+# instead of making an extra pass over all of them to infer the types.
+SONG_SCHEMA = StructType([
+    StructField('num_songs', LongType()),
+    StructField('artist_id', StringType()),
+    StructField('artist_latitude', DoubleType()),
+    StructField('artist_longitude', DoubleType()),
+    StructField('artist_location', StringType()),
+    StructField('artist_name', StringType()),
+    StructField('song_id', StringType()),
+    StructField('title', StringType()),
+    StructField('duration', DoubleType()),
+    StructField('year', LongType())
+])
+
+LOG_SCHEMA = StructType([
+    StructField('artist', StringType()),
+    StructField('auth', StringType()),
+    StructField('firstName', StringType()),
+    StructField('gender', StringType()),
+    StructField('itemInSession', LongType()),
+    StructField('lastName', StringType()),
+    StructField('length', DoubleType()),
+    StructField('level', StringType()),
+    StructField('location', StringType()),
+    StructField('method', StringType()),
+    StructField('page', StringType()),
+    StructField('registration', DoubleType()),
+    StructField('sessionId', LongType()),
+    StructField('song', StringType()),
+    StructField('status', LongType()),
+    StructField('ts', LongType()),
+    StructField('userAgent', StringType()),
+    StructField('userId', StringType())
+])
+
+SCHEMAS = {
+    'song_data': SONG_SCHEMA,
+    'log_data': LOG_SCHEMA
+}
+
+
+def read_json(spark, source, path):
+    """
+    Reads JSON files of a source with its registered schema.
+
+    :param spark: Spark instance
+    :param source: Source name, a key of SCHEMAS
+    :param path: Path or glob of the JSON files
+    """
+    return spark.read.schema(SCHEMAS[source]).json(path)
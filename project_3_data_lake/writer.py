@@ -0,0 +1,149 @@
+import math
+from pyspark import StorageLevel
+from compaction import JSON_BYTES_PER_PARQUET_BYTE, hadoop_path
+
+# Default partition columns of the output tables, an empty list for an
+# unpartitioned table
+TABLE_PARTITIONS = {
+    'songs': ['year', 'artist_id'],
+    'artists': [],
+    'users': [],
+    'time': ['year', 'month'],
+    'songplays': ['year', 'month']
+}
+
+# Written files below this size are counted as small in the report
+SMALL_FILE_BYTES = 1024 * 1024
+
+# Rows sampled to estimate the written size of a row
+SAMPLE_ROWS = 1000
+
+# Fewest rows a written file is split at, so a low size estimate cannot
+# produce a file per handful of rows
+MIN_ROWS_PER_FILE = 10000
+
+
+def estimated_size(df):
+    """
+    Returns the optimizer's estimate of a DataFrame's size in bytes, the
+    figure Spark compares with its broadcast threshold.
+
+    :param df: Spark DataFrame
+    """
+    # a Scala BigInt, which py4j may hand over as a Java object or an int
+    return int(str(df._jdf.queryExecution().optimizedPlan().stats().sizeInBytes()))
+
+
+def parse_partitioning(specs):
+    """
+    Returns the partition columns of each table, with the defaults of
+    TABLE_PARTITIONS overridden by 'TABLE=COLUMNS' specs, e.g. 'songs=year'
+    for coarser partitioning or 'songs=' for none.
+
+    :param specs: List of 'TABLE=COLUMNS' strings
+    :return: Dict of table name to partition columns
+    """
+    partitioning = dict(TABLE_PARTITIONS)
+    for spec in specs:
+        table, _, columns = spec.partition("=")
+        if table not in partitioning:
+            raise ValueError("unknown table '{}' in '{}'".format(table, spec))
+        partitioning[table] = [column.strip() for column in columns.split(",") if column.strip()]
+    return partitioning
+
+
+def write_table(df, path, partition_by, target_bytes, mode='overwrite'):
+    """
+    Writes a table as Parquet in files of about 'target_bytes'. The table
+    is cached and counted, and its size estimated from the count and the
+    width of a sample of rows; the optimizer's estimate is not used as,
+    without column statistics, it multiplies the sizes of joined inputs.
+    Rows are repartitioned by the partition columns, so each partition
+    directory is written by a single task instead of getting a file from
+    every task, and files are split at the number of rows that makes up
+    the target.
+
+    :param df: Table to write
+    :param path: output location of the table
+    :param partition_by: Partition columns, an empty list for none
+    :param target_bytes: Target size of a written file
+    :param mode: Spark save mode
+    """
+    df = df.persist(StorageLevel.MEMORY_AND_DISK)
+    rows = df.count()
+    sample = df.limit(SAMPLE_ROWS).toJSON().collect()
+    row_bytes = sum(len(row) for row in sample) / len(sample) / JSON_BYTES_PER_PARQUET_BYTE if sample else 0
+
+    n_files = max(1, min(math.ceil(rows * row_bytes / target_bytes), rows // MIN_ROWS_PER_FILE))
+    rows_per_file = max(MIN_ROWS_PER_FILE, math.ceil(target_bytes / row_bytes)) if row_bytes else MIN_ROWS_PER_FILE
+
+    if partition_by:
+        out = df.repartition(n_files, *partition_by)
+    else:
+        out = df.repartition(n_files)
+
+    out.write \
+       .option('maxRecordsPerFile', rows_per_file) \
+       .partitionBy(*partition_by) \
+       .parquet(path, mode)
+    df.unpersist()
+
+
+def merge_table(spark, df, path, key, partition_by, target_bytes):
+    """
+    Merges rows into an existing table: rows of 'df' replace the stored
+    rows with the same key and the other stored rows are kept, so merging
+    the same rows again leaves the table unchanged. The merged table is
+    written next to the old one and then swapped in, as Spark cannot
+    overwrite the files it is reading.
+
+    :param spark: Spark instance
+    :param df: Rows to merge
+    :param path: output location of the table
+    :param key: Key column
+    :param partition_by: Partition columns, an empty list for none
+    :param target_bytes: Target size of a written file
+    """
+    fs, table_path = hadoop_path(spark, path)
+    merge_path = hadoop_path(spark, path + ".merge")[1]
+    if not fs.exists(table_path) and fs.exists(merge_path):
+        # a previous merge stopped between removing the old table and renaming the new one
+        fs.rename(merge_path, table_path)
+
+    merged = df
+    if fs.exists(table_path):
+        stored = spark.read.parquet(path).select(*df.columns)
+        merged = df.unionByName(stored.join(df.select(key), key, 'left_anti'))
+
+    write_table(merged, path + ".merge", partition_by, target_bytes)
+    fs.delete(table_path, True)
+    fs.rename(merge_path, table_path)
+
+
+def file_size_report(spark, name, path):
+    """
+    Prints the number of Parquet files of a written table and their size
+    distribution.
+
+    :param spark: Spark instance
+    :param name: Table name
+    :param path: output location of the table
+    :return: Sorted file sizes in bytes
+    """
+    fs, root = hadoop_path(spark, path)
+    sizes = []
+    files = fs.listFiles(root, True)
+    while files.hasNext():
+        status = files.next()
+        if status.getPath().getName().endswith(".parquet"):
+            sizes.append(status.getLen())
+    sizes.sort()
+
+    if not sizes:
+        print('{}: no files written'.format(name))
+        return sizes
+    print('{}: {} files, {:.1f} MB; min {:.2f} MB, median {:.2f} MB, max {:.2f} MB; {} under {:.0f} MB'.format(
+        name, len(sizes), sum(sizes) / 2 ** 20,
+        sizes[0] / 2 ** 20, sizes[len(sizes) // 2] / 2 ** 20, sizes[-1] / 2 ** 20,
+        sum(1 for size in sizes if size < SMALL_FILE_BYTES), SMALL_FILE_BYTES / 2 ** 20))
+    return sizes